@@ -0,0 +1,136 @@
+import json
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Hashable
+
+
+def conditional_headers(etag: str | None, last_modified: str | None) -> dict[str, str]:
+    # Заголовки для условного GET
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    return headers
+
+
+@dataclass
+class IndexEntry:
+    links: list[tuple[str, str]]  # (href, текст ссылки) для всех .xls на странице
+    etag: str | None = None
+    last_modified: str | None = None
+    checked_at: float = field(default_factory=time.monotonic)
+
+    def age(self, now: float = None) -> float:
+        return (now or time.monotonic()) - self.checked_at
+
+    def touch(self):
+        self.checked_at = time.monotonic()
+
+    @property
+    def headers(self) -> dict[str, str]:
+        return conditional_headers(self.etag, self.last_modified)
+
+
+class IndexCache:
+    """Кэш списка .xls ссылок со страницы расписания с TTL и stale-while-revalidate."""
+
+    def __init__(self, ttl: float = 600, stale: float = 0):
+        self.ttl = ttl  # Сколько секунд запись считается свежей
+        self.stale = stale  # Сколько ещё секунд можно отдавать устаревшую запись, обновляя её в фоне
+        self._entries: dict[str, IndexEntry] = {}
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+
+    def get(self, url: str) -> IndexEntry | None:
+        return self._entries.get(url)
+
+    def put(self, url: str, entry: IndexEntry):
+        self._entries[url] = entry
+
+    def fresh(self, entry: IndexEntry | None) -> bool:
+        return entry is not None and entry.age() < self.ttl
+
+    def usable_stale(self, entry: IndexEntry | None) -> bool:
+        return entry is not None and self.stale > 0 and entry.age() < self.ttl + self.stale
+
+    def clear(self):
+        self._entries.clear()
+
+    def __str__(self):
+        return f"IndexCache(записей: {len(self._entries)}; свежих: {self.hits}; устаревших: {self.stale_hits}; промахов: {self.misses})"
+
+
+class LRUCache:
+    """LRU-кэш с ограничением по числу записей и необязательным сохранением в JSON."""
+
+    def __init__(self, max_size: int = 256, path: Path | None = None,
+                 dump: Callable[[Any], Any] = None, load: Callable[[Any], Any] = None):
+        self.max_size = max_size
+        self.path = path
+        self.dump = dump or (lambda value: value)
+        self.load = load or (lambda value: value)
+        self._data: OrderedDict[Hashable, Any] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable):
+        value = self._data.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._data.move_to_end(key)
+        return value
+
+    def put(self, key: Hashable, value: Any):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def keys(self) -> list[Hashable]:
+        return list(self._data.keys())
+
+    def peek(self, key: Hashable):
+        """Значение без учёта в статистике и без изменения порядка."""
+        return self._data.get(key)
+
+    def clear(self):
+        self._data.clear()
+
+    def remove_where(self, predicate: Callable[[Hashable], bool]) -> int:
+        keys = [key for key in self._data if predicate(key)]
+        for key in keys:
+            del self._data[key]
+        return len(keys)
+
+    def __len__(self):
+        return len(self._data)
+
+    def read(self):
+        if self.path is None or not self.path.exists():
+            return
+        try:
+            for key, value in json.loads(self.path.read_text("utf-8")):
+                self.put(tuple(key), self.load(value))
+            print(f"Кэш загружен: {self.path} ({len(self)} записей).")
+        except (json.JSONDecodeError, TypeError, ValueError, KeyError):
+            print(f"WARN: Кэш поврежден и будет пересобран: {self.path}.")
+            self.clear()
+
+    def save(self):
+        if self.path is None:
+            return
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        tmp_path.write_text(json.dumps([[list(k), self.dump(v)] for k, v in self._data.items()], ensure_ascii=False), "utf-8")
+        os.replace(tmp_path, self.path)
+
+    def __str__(self):
+        total = self.hits + self.misses
+        rate = self.hits / total * 100 if total else 0
+        return f"LRUCache(записей: {len(self)}/{self.max_size}; попаданий: {self.hits}; промахов: {self.misses}; {rate:.0f}%)"
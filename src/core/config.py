@@ -1,10 +1,14 @@
+import asyncio
+import copy
 import json
 import sys
 import traceback
-from collections import defaultdict
 from dataclasses import dataclass, asdict, field
 from pathlib import Path
 
+from .storage import JsonStorage, SqliteStorage, StorageError, write_atomic
+from .watcher import diff_keys
+
 # 10.2024
 AvailableFind = (
     # Очное отделение
@@ -126,6 +130,18 @@ class ChatConfig:
     def save(self):
         pass
 
+    def __setattr__(self, name, value):
+        if self.__dict__.get("_shared"):
+            raise AttributeError("Настройки по умолчанию общие для всех чатов; меняйте чат через Config.edit_chat")
+        super().__setattr__(name, value)
+
+    @classmethod
+    def shared(cls, **kwargs) -> "ChatConfig":
+        """Неизменяемый экземпляр: отдаётся всем чатам, у которых нет своих настроек."""
+        chat = cls(**kwargs)
+        chat.__dict__["_shared"] = True
+        return chat
+
 class Config:
 
     def __init__(self, global_config):
@@ -135,8 +151,12 @@ class Config:
             "admins": [],  # тот кто может менять save_path + links, templates
             "save_path": "./downloads/",
             "chats_store": "./storage/chats.json",
+            "chats_flush_delay": 2,  # Секунды: изменения чатов за это время записываются одним разом
+            "watch_interval": 5,  # Секунды между проверками хранилища на изменения извне; 0 - не проверять
             "links": "./storage/links.json",
             "templates": "./storage/templates.json",
+            "storage": "json",  # json или sqlite; JSON файлы выше остаются форматом импорта и экспорта
+            "storage_db": "./storage/bot.sqlite3",
             "default": {
                 "url": "http://www.fa.ru/fil/krasnodar/student/Pages/schedule.aspx",
                 "find": None,
@@ -150,12 +170,57 @@ class Config:
                 "time_pattern": "%H:%M:%S",
                 "date_pattern": "%d.%m.%Y",
                 "prune_rule": "every|none|00:00:00",
+                "journal": "./storage/scheduler.sqlite3",
+                "jitter": 60,
+                "catch_up": 300,
+                "max_concurrent": 10,
+            },
+            "download": {
+                "connect_timeout": 5,
+                "read_timeout": 30,
+                "max_connections": 10,
+                "chunk_size": 65536,
+                "index_ttl": 600,
+                "index_stale": 3600,
+                "file_ttl": 300,
+                "max_size_mb": 200,
+                "max_age_days": 30,
+                "evict_interval": 3600,
+            },
+            "cache": {
+                "weeks_size": 256,
+                "weeks_store": "./storage/weeks.json",
+                "preparse": True,
+                "renders_size": 1024,
+            },
+            "parse": {
+                "workers": 2,
+                "queue_size": 32,
+            },
+            "refresh": {
+                "interval": 1800,  # Как часто перепроверять файлы запланированных чатов; 0 - не проверять
+            },
+            "send": {
+                "rate": 30,
+                "chat_rate": 1,
+                "group_per_minute": 20,
+                "workers": 4,
+                "queue_size": 1000,
+                "max_retries": 3,
             }
         }
         self.__init_config_file()
         self.__check()
-        self.__chats: dict[int, ChatConfig] = defaultdict(lambda: ChatConfig(**self.__config_raw["default"]))
+        # Только чаты со своими настройками; остальные читают общий default_chat
+        self.__chats: dict[int, ChatConfig] = {}
+        self.default_chat = ChatConfig.shared(**copy.deepcopy(self.__config_raw["default"]))
         self.chats_store = Path(self.__config_raw["chats_store"])
+        self.json_storage = JsonStorage(self.chats_store, self.links, self.templates)
+        self.storage = self.__open_storage()
+        self._dirty: set[int] = set()
+        self._flushing: set[int] = set()  # Чаты, которые сейчас пишутся в потоке
+        self._flush_handle: asyncio.TimerHandle | None = None
+        self._flush_task: asyncio.Future | None = None
         self.__init_chats_store()
         self.save()
 
@@ -166,9 +231,10 @@ class Config:
             sys.exit(0)
         try:
             _raw = json.loads(self.config_file.read_text("utf-8"))
+            # Вложенные секции дополняем, чтобы новые ключи получали значения по умолчанию
+            for section in ("default", "scheduler", "download", "cache", "parse", "refresh", "send"):
+                self.__config_raw[section].update(_raw.pop(section, {}))
             self.__config_raw.update(_raw)
-            self.__config_raw['default'].update(_raw['default'])
-            self.__config_raw['scheduler'].update(_raw['scheduler'])
         except json.JSONDecodeError:
             print(f"Файл с конфигурацией поврежден: {self.config_file}.\nНастройте его (или удалите для пересоздания) и перезапустите.")
             sys.exit(0)
@@ -195,34 +261,67 @@ class Config:
             self.save_path.mkdir(parents=True)
         print("Конфигурация проверена.")
 
+    def __open_storage(self) -> JsonStorage | SqliteStorage:
+        kind = self.__config_raw["storage"]
+        if kind == "json":
+            return self.json_storage
+        if kind != "sqlite":
+            print(f"ERR: Неизвестное хранилище: {kind!r}. Доступны: json, sqlite.")
+            exit(1)
+        storage = SqliteStorage(Path(self.__config_raw["storage_db"]))
+        if storage.empty():
+            try:
+                print(f"База пуста, импорт из JSON. {storage.import_from(self.json_storage)}")
+            except StorageError as e:
+                print(f"WARN: {e}. Импорт пропущен.")
+        return storage
+
+    def __load_chats(self):
+        for k, _v in self.storage.load_chats().items():
+            v = self.__config_raw['default'].copy()
+            v.update(_v)
+            self.__chats[k] = ChatConfig(**v)
+
     def __init_chats_store(self):
-        if not self.chats_store.exists():
-            self.chats_store.write_text(json.dumps({}), "utf-8")
-            print(f"Файл с настройками чатов создан: {self.chats_store}.")
         try:
-            for k, _v in json.loads(self.chats_store.read_text("utf-8")).items():
-                v = self.__config_raw['default'].copy()
-                v.update(_v)
-                self.__chats[int(k)] = ChatConfig(**v)
-        except json.JSONDecodeError or TypeError as e:
-            print(f"Файл с чатами поврежден: {self.chats_store}.\nИсправьте его (или удалите для пересоздания) и перезапустите.")
+            self.__load_chats()
+        except (StorageError, TypeError) as e:
+            print(f"ERR: {e}.\nИсправьте настройки чатов (или удалите файл для пересоздания) и перезапустите.")
             traceback.print_exc()
             sys.exit(1)
-        print("Файл с настройками чатов загружен.")
+        print(f"Настройки чатов загружены: {self.storage}.")
 
     def reload_chats(self):
         old = self.__chats.copy()
         self.__chats.clear()
         try:
-            for k, _v in json.loads(self.chats_store.read_text("utf-8")).items():
-                v = self.__config_raw['default'].copy()
-                v.update(_v)
-                self.__chats[int(k)] = ChatConfig(**v)
+            self.__load_chats()
+            # Несохранённые изменения перетираются хранилищем
+            self._dirty.clear()
             return "Настройки чатов перезагружены."
-        except json.JSONDecodeError or TypeError:
+        except (StorageError, TypeError) as e:
             traceback.print_exc()
             self.__chats = old
-            return f"Файл с чатами поврежден: {self.chats_store}. Изменения не применены."
+            return f"{e}. Изменения не применены."
+
+    def apply_chats(self, raw: dict[int, dict]) -> tuple[set, set, set]:
+        """Применяет изменения из хранилища. Чаты с несохранёнными изменениями не трогаем."""
+        chats = {}
+        for k, _v in raw.items():
+            v = copy.deepcopy(self.__config_raw['default'])
+            v.update(_v)
+            chats[k] = ChatConfig(**v)
+        added, removed, changed = diff_keys(self.__chats, chats)
+        local = self._dirty | self._flushing
+        added, removed, changed = added - local, removed - local, changed - local
+        if added or removed or changed:
+            new = self.__chats.copy()
+            for chat_id in added | changed:
+                new[chat_id] = chats[chat_id]
+            for chat_id in removed:
+                del new[chat_id]
+            self.__chats = new
+        return added, removed, changed
 
     @property
     def token(self) -> str | None:
@@ -263,13 +362,98 @@ class Config:
     def scheduler(self) -> dict[str, str]:
         return self.__config_raw["scheduler"]
 
+    @property
+    def download(self) -> dict[str, int]:
+        return self.__config_raw["download"]
+
+    @property
+    def cache(self) -> dict[str, int | str | None]:
+        return self.__config_raw["cache"]
+
+    @property
+    def parse(self) -> dict[str, int]:
+        return self.__config_raw["parse"]
+
+    @property
+    def refresh(self) -> dict[str, int]:
+        return self.__config_raw["refresh"]
+
+    @property
+    def send(self) -> dict[str, int]:
+        return self.__config_raw["send"]
+
     def save(self):
-        self.config_file.write_text(json.dumps(self.__config_raw, indent=4), "utf-8")
-        self.save_chats()
+        write_atomic(self.config_file, json.dumps(self.__config_raw, indent=4))
+
+    def _take_dirty(self) -> dict[int, dict | None]:
+        chats = {chat_id: asdict(self.__chats[chat_id]) if chat_id in self.__chats else None for chat_id in self._dirty}
+        self._dirty.clear()
+        return chats
 
-    def save_chats(self):
-        with open(self.chats_store, "w", encoding="utf-8") as f:
-            f.write(json.dumps({k: asdict(v) for k, v in self.__chats.items()}, indent=4))
+    def _mark_dirty(self, *chat_ids: int):
+        # Запись на диск - через chats_flush_delay секунд в отдельном потоке
+        self._dirty.update(chat_ids)
+        if self._flush_handle is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush_chats()
+            return
+        self._flush_handle = loop.call_later(self.__config_raw["chats_flush_delay"], self._start_flush)
 
-    def get_chat(self, chat_id):
-        return self.__chats[chat_id]
+    def _start_flush(self):
+        self._flush_handle = None
+        if self._flush_task is not None and not self._flush_task.done():
+            # Предыдущая запись ещё идёт; эта подождёт, чтобы файлы не записались в обратном порядке
+            self._flush_handle = asyncio.get_running_loop().call_later(self.__config_raw["chats_flush_delay"], self._start_flush)
+            return
+        if not self._dirty:
+            return
+        self._flushing = set(self._dirty)
+        self._flush_task = asyncio.ensure_future(asyncio.to_thread(self.storage.save_chats, self._take_dirty()))
+        self._flush_task.add_done_callback(lambda _: self._flushing.clear())
+
+    def flush_chats(self):
+        if self._dirty:
+            self.storage.save_chats(self._take_dirty())
+
+    async def close(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._flush_task is not None:
+            await self._flush_task
+        self.flush_chats()
+        self.storage.close()
+
+    def get_chat(self, chat_id) -> ChatConfig:
+        """Настройки чата только для чтения; для изменения - edit_chat."""
+        return self.__chats.get(chat_id, self.default_chat)
+
+    def edit_chat(self, chat_id) -> ChatConfig:
+        # Свой экземпляр создаётся при первом изменении настроек
+        chat = self.__chats.get(chat_id)
+        if chat is None:
+            chat = self.__chats[chat_id] = ChatConfig(**copy.deepcopy(self.__config_raw["default"]))
+        # Сразу: пока обработчик ждёт ответа, перечитывание хранилища не должно затереть изменение
+        self._mark_dirty(chat_id)
+        return chat
+
+    def compact_chats(self) -> int:
+        """Забывает чаты, настройки которых совпадают с настройками по умолчанию."""
+        default = ChatConfig(**self.__config_raw["default"])
+        same = [chat_id for chat_id, chat in self.__chats.items() if chat == default]
+        for chat_id in same:
+            del self.__chats[chat_id]
+        if same:
+            self._mark_dirty(*same)
+        return len(same)
+
+    @property
+    def watch_interval(self) -> float:
+        return self.__config_raw["watch_interval"]
+
+    @property
+    def chats_count(self) -> int:
+        return len(self.__chats)
@@ -0,0 +1,65 @@
+import json
+import sqlite3
+from pathlib import Path
+
+
+class TaskJournal:
+    """
+    Журнал задач планировщика в SQLite. Пишется по мере добавления и снятия задач,
+    читается целиком при старте. Правило хранится уже разобранным, чтобы не парсить строки при загрузке.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS tasks ("
+            " id INTEGER PRIMARY KEY,"
+            " name TEXT NOT NULL,"
+            " owner INTEGER,"
+            " kind TEXT NOT NULL,"
+            " rule TEXT NOT NULL,"
+            " mode TEXT NOT NULL,"
+            " weekdays INTEGER NOT NULL,"
+            " date INTEGER,"  # date.toordinal()
+            " seconds INTEGER NOT NULL,"
+            " payload TEXT"
+            ")"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS tasks_owner ON tasks (owner)")
+        self.db.commit()
+        self._next_id = (self.db.execute("SELECT MAX(id) FROM tasks").fetchone()[0] or 0) + 1
+
+    def new_id(self) -> int:
+        task_id = self._next_id
+        self._next_id += 1
+        return task_id
+
+    def load(self) -> list[tuple]:
+        """(id, name, owner, kind, rule, mode, weekdays, date, seconds, payload) для всех задач."""
+        rows = self.db.execute("SELECT id, name, owner, kind, rule, mode, weekdays, date, seconds, payload FROM tasks").fetchall()
+        # Все payload разбираются одним вызовом json.loads: на десятках тысяч строк это заметно быстрее
+        payloads = json.loads("[" + ",".join(row[-1] or "null" for row in rows) + "]")
+        return [row[:-1] + (payload,) for row, payload in zip(rows, payloads)]
+
+    def add(self, rows: list[tuple]):
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO tasks (id, name, owner, kind, rule, mode, weekdays, date, seconds, payload) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [row[:-1] + (json.dumps(row[-1], ensure_ascii=False) if row[-1] is not None else None,) for row in rows]
+            )
+
+    def remove(self, *ids: int):
+        with self.db:
+            self.db.executemany("DELETE FROM tasks WHERE id = ?", [(i,) for i in ids])
+
+    def remove_owner(self, owner: int):
+        with self.db:
+            self.db.execute("DELETE FROM tasks WHERE owner = ?", (owner,))
+
+    def close(self):
+        self.db.close()
@@ -1,21 +1,50 @@
-import json
+import asyncio
+import hashlib
 import os
 import sys
+import time
 import urllib.parse
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, asdict, astuple
+from functools import cached_property
 from pathlib import Path
 
+import httpx
+import numpy as np
 import pandas as pd
-import requests
+import xlrd
 from bs4 import BeautifulSoup
 
-from .config import ChatConfig
+from .cache import IndexCache, IndexEntry, LRUCache
+from .config import ChatConfig, AvailableSheetOFO, AvailableSheetOZFO, AvailableSheetZFO
 from .scheduler import Task
+from .singleflight import SingleFlight
+from .storage import JsonStorage, SqliteStorage, StorageError
+from .store import FileStore, StoredFile
+from .watcher import diff_keys
+from .workers import ParsePool
 
-def fix_nan(x):
-    if pd.isna(x):
-        return None
-    return x
+KnownSheets = frozenset(AvailableSheetOFO + AvailableSheetOZFO + AvailableSheetZFO)
+
+
+def with_parity(sheet_name: str, even_week: bool | None) -> str:
+    if even_week is False:
+        return sheet_name + " НЧН"
+    if even_week is True:
+        return sheet_name + " ЧН"
+    return sheet_name
+
+
+def split_parity(sheet_name: str) -> tuple[str, bool | None]:
+    if sheet_name.endswith(" НЧН"):
+        return sheet_name.removesuffix(" НЧН"), False
+    if sheet_name.endswith(" ЧН"):
+        return sheet_name.removesuffix(" ЧН"), True
+    return sheet_name, None
+
+
+def content_hash(obj: "Week | Day | Lesson") -> str:
+    # Одинаковое содержимое даёт одинаковый хэш, даже если это разные объекты (другой файл, другой чат)
+    return hashlib.blake2b(f"{type(obj).__name__}{astuple(obj)!r}".encode(), digest_size=16).hexdigest()
 
 @dataclass
 class Lesson:
@@ -30,16 +59,15 @@ class Lesson:
     def empty(self):
         return self.name is None
 
-    def replace(self, old, new):
-        if self.name:
-            self.name = self.name.replace(old, new)
-        if self.place:
-            self.place = self.place.replace(old, new)
+    @property
+    def start(self) -> tuple[int, int]:
+        # "8.30-10.00" -> (8, 30)
+        h, m = map(int, self.time.split("-")[0].split("."))
+        return h, m
 
     @property
     def task_time(self):
-        t_start = self.time.split("-")[0]
-        h, m = map(int, t_start.split("."))
+        h, m = self.start
         if m < 5:
             h -= 1
             m = 55
@@ -47,6 +75,11 @@ class Lesson:
             m -= 5
         return f"{h}:{m}:00"
 
+    @cached_property
+    def digest(self) -> str:
+        # Считается после разбора, когда объект уже не меняется
+        return content_hash(self)
+
     def __str__(self):
         return f"    L:{self.num} {self.time!r} {self.name!r} {self.teacher!r} {self.place!r} link:{bool(self.link)}"
 
@@ -64,16 +97,21 @@ class Day:
     def add_lesson(self, lesson: Lesson):
         self.lessons.append(lesson)
 
-    def tasks(self, callback, chat_id):
+    def tasks(self, callback, chat_id, source: dict):
+        # source - ссылка на день: файл, лист, чётность и номер дня; к ней добавляется номер пары
         tasks = []
-        for lesson in self.lessons:
+        for i, lesson in enumerate(self.lessons):
             if lesson.empty:
                 continue
+            payload = {**source, "lesson": i}
             task = Task(
                 f"I:{chat_id} L:{lesson.num}",
                 callback,
-                args=(chat_id,),
-                rule=f"once|{self.date}|{lesson.task_time}"
+                args=(chat_id, payload),
+                rule=f"once|{self.date}|{lesson.task_time}",
+                owner=chat_id,
+                kind="lesson",
+                payload=payload
             )
             tasks.append(task)
         return tasks
@@ -82,6 +120,10 @@ class Day:
     def empty(self):
         return all(lesson.empty for lesson in self.lessons)
 
+    @cached_property
+    def digest(self) -> str:
+        return content_hash(self)
+
     def __str__(self):
         return f"  Day {self.date!r} with {len(self.lessons)} lessons;\n" + "\n".join(str(lesson) for lesson in self.lessons)
 
@@ -93,13 +135,40 @@ class Week:
     def add_day(self, day: Day):
         self.days.append(day)
 
-    def tasks(self, callback, chat_id, notify_day_at):
+    def tasks(self, callback, chat_id, notify_day_at, source: dict):
+        """source - откуда неделя: {"sha256": ..., "sheet": ..., "even_week": ..., "auto": ...}; по нему задача найдёт свой день."""
         tasks = []
-        for day in self.days:
-            tasks.append(Task(f"I:{chat_id} D:{day.day_name}", callback, args=(chat_id,), rule=f"once|{day.date}|{notify_day_at}"))
-            tasks.extend(day.tasks(callback, chat_id))
+        for i, day in enumerate(self.days):
+            payload = {**source, "day": i}
+            tasks.append(Task(f"I:{chat_id} D:{day.day_name}", callback, args=(chat_id, payload), rule=f"once|{day.date}|{notify_day_at}",
+                              owner=chat_id, kind="day", payload=payload))
+            tasks.extend(day.tasks(callback, chat_id, payload))
         return tasks
 
+    def resolve(self, payload: dict) -> "Day | Lesson":
+        day = self.days[payload["day"]]
+        if "lesson" in payload:
+            return day.lessons[payload["lesson"]]
+        return day
+
+    def pack(self) -> tuple:
+        # Компактный вид для передачи из процесса разбора: только кортежи и строки
+        return astuple(self)
+
+    @classmethod
+    def unpack(cls, data: tuple) -> "Week":
+        date, days = data
+        return cls(date, [Day(day_name, day_date, [Lesson(*lesson) for lesson in lessons]) for day_name, day_date, lessons in days])
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Week":
+        days = [Day(d["day_name"], d["date"], [Lesson(**lesson) for lesson in d["lessons"]]) for d in data["days"]]
+        return cls(data["date"], days)
+
+    @cached_property
+    def digest(self) -> str:
+        return content_hash(self)
+
     def __str__(self):
         return f"Week {self.date!r} with {len(self.days)} days;\n" + "\n".join(str(day) for day in self.days)
 
@@ -125,132 +194,360 @@ class Parser:
     len_week = 5 # Длина недели в днях
     len_lessons = 8 # Количество пар в день
 
-    def __init__(self, links_path: Path, save_path: Path):
-        self.links_path = links_path
+    def __init__(self, storage: JsonStorage | SqliteStorage, save_path: Path, download: dict = None, cache: dict = None,
+                 pool: ParsePool = None):
+        self.storage = storage
         self.save_path = save_path
-        if not self.links_path.exists():
-            raise FileNotFoundError(f"Links file not found: {self.links_path}")
+        self.pool = pool
+        self.download_settings = download or {}
+        self.cache_settings = cache or {}
+        self._session: httpx.AsyncClient | None = None
+        self.store = FileStore(save_path)
+        self.downloads = SingleFlight("download")
+        # Одновременные промахи кэша по одному файлу ждут один разбор
+        self.parses = SingleFlight("parse")
+        self._preparsed: set[str] = set()  # Книги, уже разобранные целиком: дальше промахи читают по одному листу
+        self.index_cache = IndexCache(self.download_settings.get("index_ttl", 600),
+                                      self.download_settings.get("index_stale", 0))
+        self._index_flights = SingleFlight("index")
+        self._background: set[asyncio.Task] = set()
+        # Распарсенные недели: (sha256 файла, лист, чётность) -> Week
+        weeks_store = self.cache_settings.get("weeks_store")
+        self.weeks = LRUCache(self.cache_settings.get("weeks_size", 256), Path(weeks_store) if weeks_store else None, asdict, Week.from_dict)
+        self.weeks.read()
         if not self.save_path.exists():
             raise FileNotFoundError(f"Save path not found: {self.save_path}")
         self._links = {}
         self._read()
+        self._drop_stale_weeks()
 
         # список дней недели в строках
         self.week = [(self.row_start + self.len_day * i, self.row_start + self.len_day * (i + 1)) for i in range(self.len_week)]
 
     def _read(self):
-        if not self.links_path.exists():
-            print("ERR: Файл с ссылками не найден. Восстановите его и перезапустите.")
-            sys.exit(1)
         try:
-            self._links.update(json.loads(self.links_path.read_text("utf-8")))
-            print("Файл с ссылками загружен.")
-        except json.JSONDecodeError:
-            print("ERR: Файл с ссылками поврежден. Восстановите его и перезапустите.")
+            self._links.update(self.storage.load_links())
+            print("Ссылки загружены.")
+        except StorageError as e:
+            print(f"ERR: {e}. Восстановите его и перезапустите.")
             sys.exit(1)
 
+    def _drop_stale_weeks(self):
+        # Сохранённые недели разобраны со ссылками на момент разбора; если ссылки поменялись, пока бот был выключен, такие недели не годятся
+        stale = self.weeks.remove_where(lambda key: not self._links_match(self.weeks.peek(key)))
+        if stale:
+            print(f"Ссылки изменились: из кэша недель удалено {stale} записей.")
+
+    def _links_match(self, week: "Week") -> bool:
+        return all(lesson.link == teacher_link(lesson.teacher, self._links)
+                   for day in week.days if not isinstance(day, str)
+                   for lesson in day.lessons if lesson.teacher is not None)
+
     @property
     def links(self):
         return self._links
 
     def reload(self):
-        if not self.links_path.exists():
-            self.links_path.write_text(json.dumps(self._links), "utf-8")
-            return "ERR: Файл с шаблонами не найден. Файл восстановлен."
-        old = self._links.copy()
-        self._links.clear()
         try:
-            j = json.loads(self.links_path.read_text("utf-8"))
-            if len(j) == 0:
-                return "ERR: Файл с ссылками пуст. Изменения не применены."
-            self._links.update(j)
-            return "Ссылки перезагружены."
-        except json.JSONDecodeError:
-            self._links = old
-            return "ERR: Файл с ссылками поврежден. Изменения не применены."
-
-    def download(self, chat: ChatConfig, even_week: bool):
-        response = requests.get(chat.url)
-        if response.status_code == 200:
-            # Парсим HTML-код страницы
-            soup = BeautifulSoup(response.text, 'html.parser')
-
-            # Ищем ссылку на файл с расписанием
-            anchors = soup.find_all('a')
-            link = [urllib.parse.unquote(a.get('href')) for a in anchors if
-                    a.get('href') and a.get("href").endswith(".xls") and chat.find in a.text]
-
-            if link:
-                link = link[1 if even_week else 0]
-                # Получаем полный URL файла
-                file_url = "http://www.fa.ru" + link
-                file_name = os.path.basename(link).replace("'", "").replace(" ", "_")
-                file_path = self.save_path / file_name
-
-                if os.path.exists(file_path):
-                    print(f"Файл '{file_name}' уже существует.")
-                    return file_path
-
-                # Сохраняем файл на локальном диске
-                with open(file_path, 'wb') as file:
-                    file.write(requests.get(file_url).content)
-
-                print(f"Файл '{file_name}' успешно скачан!")
-                return file_path
-            else:
-                print("Ссылка на файл с расписанием не найдена.")
+            links = self.storage.load_links()
+        except StorageError as e:
+            return f"ERR: {e}. Изменения не применены."
+        if len(links) == 0:
+            return "ERR: Ссылок нет. Изменения не применены."
+        self._links = links
+        # Ссылки подставляются при разборе, поэтому старые недели больше не годятся
+        self.weeks.clear()
+        return "Ссылки перезагружены."
+
+    def apply_links(self, links: dict[str, str]) -> tuple[set, set, set] | None:
+        if not links:
+            print("WARN: Ссылок нет, изменения не применены.")
+            return None
+        diff = diff_keys(self._links, links)
+        if any(diff):
+            self._links = links
+            self.weeks.clear()
+        return diff
+
+    @property
+    def session(self) -> httpx.AsyncClient:
+        # Одна сессия на все чаты: соединения с fa.ru переиспользуются
+        if self._session is None or self._session.is_closed:
+            connect = self.download_settings.get("connect_timeout", 5)
+            read = self.download_settings.get("read_timeout", 30)
+            max_connections = self.download_settings.get("max_connections", 10)
+            self._session = httpx.AsyncClient(
+                timeout=httpx.Timeout(read, connect=connect),
+                limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+                follow_redirects=True,
+            )
+        return self._session
+
+    async def close(self):
+        for task in self._background:
+            task.cancel()
+        if self._session is not None:
+            await self._session.aclose()
+            self._session = None
+
+    @staticmethod
+    def _find_links(html: str) -> list[tuple[str, str]]:
+        # Парсим HTML-код страницы
+        soup = BeautifulSoup(html, 'html.parser')
+
+        # Собираем все ссылки на .xls; нужный курс выбирается уже из кэша
+        anchors = soup.find_all('a')
+        return [(urllib.parse.unquote(a.get('href')), a.text) for a in anchors if
+                a.get('href') and a.get("href").endswith(".xls")]
+
+    async def _revalidate_index(self, url: str) -> IndexEntry | None:
+        entry = self.index_cache.get(url)
+        try:
+            response = await self.session.get(url, headers=entry.headers if entry else None)
+        except httpx.HTTPError as e:
+            print(f"Не удалось получить страницу: {e!r}")
+            return entry
+        if response.status_code == 304 and entry is not None:
+            entry.touch()
+            return entry
+        if response.status_code != 200:
+            print(f"Не удалось получить страницу. Код ответа: {response.status_code}")
+            return entry
+        links = await asyncio.to_thread(self._find_links, response.text)
+        entry = IndexEntry(links, response.headers.get("ETag"), response.headers.get("Last-Modified"))
+        self.index_cache.put(url, entry)
+        return entry
+
+    async def _index(self, url: str) -> list[tuple[str, str]] | None:
+        entry = self.index_cache.get(url)
+        if self.index_cache.fresh(entry):
+            self.index_cache.hits += 1
+            return entry.links
+        if self.index_cache.usable_stale(entry):
+            # Отдаём устаревший список сразу, а страницу перепроверяем в фоне
+            self.index_cache.stale_hits += 1
+            if url not in self._index_flights.flights:
+                task = asyncio.create_task(self._index_flights.do(url, self._revalidate_index, url))
+                self._background.add(task)
+                task.add_done_callback(self._background.discard)
+            return entry.links
+        self.index_cache.misses += 1
+        entry, _waiters = await self._index_flights.do(url, self._revalidate_index, url)
+        return entry.links if entry else None
+
+    async def _fetch(self, key: str, file_url: str, file_name: str, entry: StoredFile | None) -> StoredFile:
+        # Пишем во временный файл, чтобы оборванная загрузка не оставила битый .xls
+        tmp_path = self.store.temp_path()
+        chunk_size = self.download_settings.get("chunk_size", 65536)
+        sha = hashlib.sha256()
+        try:
+            async with self.session.stream("GET", file_url, headers=entry.headers if entry else None) as response:
+                if response.status_code == 304 and entry is not None:
+                    print(f"Файл '{file_name}' не изменился.")
+                    return self.store.touch(key)
+                response.raise_for_status()
+                with open(tmp_path, 'wb') as file:
+                    async for chunk in response.aiter_bytes(chunk_size):
+                        sha.update(chunk)
+                        file.write(chunk)
+            stored = self.store.commit(key, file_name, tmp_path, sha.hexdigest(),
+                                       response.headers.get("ETag"), response.headers.get("Last-Modified"))
+        finally:
+            if tmp_path.exists():
+                tmp_path.unlink()
+        if entry is None:
+            print(f"Файл '{file_name}' успешно скачан!")
+        elif entry.sha256 != stored.sha256:
+            print(f"Файл '{file_name}' обновлён на сайте.")
         else:
-            print("Не удалось получить страницу.")
+            print(f"Файл '{file_name}' не изменился.")
+        return stored
+
+    async def download(self, chat: ChatConfig, even_week: bool):
+        # Чаты с одинаковыми url/find в один момент ждут одну загрузку
+        stored, _waiters = await self.downloads.do((chat.url, chat.find, even_week), self._download, chat.url, chat.find, even_week)
+        return stored
+
+    async def _download(self, url: str, find: str, even_week: bool):
+        links = await self._index(url)
+        if links is None:
+            return None
+        link = [href for href, text in links if find in text]
+
+        if link:
+            link = link[1 if even_week else 0]
+            # Получаем полный URL файла
+            file_url = "http://www.fa.ru" + link
+            file_name = os.path.basename(link).replace("'", "").replace(" ", "_")
+            key = self.store.key(file_url, even_week)
+            entry = self.store.get(key)
+
+            if entry is not None and time.time() - entry.fetched_at < self.download_settings.get("file_ttl", 300):
+                print(f"Файл '{file_name}' уже существует.")
+                return entry
+
+            # Сверяем с сайтом и при изменениях сохраняем файл на локальном диске
+            try:
+                return await self._fetch(key, file_url, file_name, entry)
+            except httpx.HTTPError as e:
+                print(f"Не удалось скачать файл '{file_name}': {e!r}")
+                return entry
+        print("Ссылка на файл с расписанием не найдена.")
         return None
 
-    def parse_xml(self, chat: ChatConfig, file_path, even_week=None):
-        sheet_name = chat.sheet_name
-        if even_week is False:
-            sheet_name += " НЧН"
-        if even_week is True:
-            sheet_name += " ЧН"
-        print(f"Читаю {sheet_name!r} в файле.")
-
-        sheet_names = list(pd.read_excel(file_path, sheet_name=None).keys())
-        if sheet_name not in sheet_names:
-            return f"\nЛист `{sheet_name}` не доступен. Доступные листы: \n{'\n'.join(sheet_names)}\n"
+    @staticmethod
+    def open_workbook(file_path) -> pd.ExcelFile:
+        # on_demand: при открытии читаются только метаданные книги, листы декодируются по запросу
+        return pd.ExcelFile(xlrd.open_workbook(file_path, on_demand=True))
+
+    @classmethod
+    def read_week(cls, xls: pd.ExcelFile, sheet_name: str, links: dict[str, str]) -> Week:
+        # Загружаем в DataFrame только нужный лист, строки до конца недели и столбцы до аудитории
+        df = xls.parse(sheet_name, nrows=cls.row_end, usecols=range(cls.col_aud + 1))
+        xls.book.unload_sheet(sheet_name)
+
+        week = Week(df.iloc[cls.row_week, cls.col_week])
 
-        # Загружаем данные из .xls в DataFrame
-        df = pd.read_excel(file_path, sheet_name=sheet_name)
+        # Забираем нужные столбцы одним срезом и заменяем NaN на None одной маской
+        cols = [cls.col_date, cls.col_num, cls.col_time, cls.col_name, cls.col_aud]
+        block = df.iloc[cls.row_start:cls.row_end, cols].to_numpy(dtype=object)
+        block = np.where(pd.isna(block), None, block)
+        # дни x пары x строки пары x столбцы
+        block = block.reshape(cls.len_week, cls.len_day // cls.rows_lesson, cls.rows_lesson, len(cols))
 
-        week = Week(df.iloc[self.row_week, self.col_week])
-        for j, (start_day, end_day) in enumerate(self.week):  # Перебираем дни
+        for day_rows in block:  # Перебираем дни
             day = Day()
             c = 0  # class
-            offset = 0  # offset
-            for i in range(start_day, end_day):  # Перебираем пары
-                if offset > 1:
-                    offset = 0
-                date = df.iloc[i, self.col_date]
-                if offset == 0:
-                    lesson = Lesson(c)
-                    if not pd.isna(date):
-                        day.set_date(date)
-                    num = df.iloc[i, self.col_num]
-                    if not pd.isna(num):
-                        c = int(num) - 1
-                    lesson.name = fix_nan(df.iloc[i, self.col_name])
-                    lesson.time = fix_nan(df.iloc[i, self.col_time])
-                    lesson.place = fix_nan(df.iloc[i, self.col_aud])
-                    day.add_lesson(lesson)
-                if offset == self.offset_teacher:
-                    lesson = day.lessons[c]
-                    lesson.teacher = fix_nan(df.iloc[i, self.col_name])
-                    if lesson.teacher is not None:
-                        lesson.teacher = lesson.teacher.lower().capitalize()
-                        lesson.link = self.links.get(lesson.teacher.split(" ")[0].lower(), None)
-                offset += 1
+            for lesson_rows in day_rows:  # Перебираем пары
+                date, num, lesson_time, name, place = lesson_rows[0]
+                lesson = Lesson(c)
+                if date is not None:
+                    day.set_date(date)
+                if num is not None:
+                    c = int(num) - 1
+                lesson.name = name
+                lesson.time = lesson_time
+                lesson.place = place
+                day.add_lesson(lesson)
+
+                _, _, _, teacher, _ = lesson_rows[cls.offset_teacher]
+                lesson = day.lessons[c]
+                lesson.teacher = teacher
+                if lesson.teacher is not None:
+                    lesson.teacher = lesson.teacher.lower().capitalize()
+                    lesson.link = teacher_link(lesson.teacher, links)
             week.add_day(day)
         return week
 
-    def get_data(self, chat: ChatConfig, even_week: bool):
-        file_path = self.download(chat, even_week)
-        if file_path is None:
+    def parse_xml(self, chat: ChatConfig, file_path, even_week=None):
+        return parse_sheet(file_path, with_parity(chat.sheet_name, even_week), self.links)
+
+    def parse_workbook(self, file_path) -> dict[tuple[str, bool | None], Week]:
+        """
+        Разбирает за один проход все известные листы книги, обе чётности.
+        Ключ результата - (лист без чётности, чётность), как в настройках чата.
+        """
+        with self.open_workbook(file_path) as xls:
+            sheet_names = known_sheets(xls)
+            print(f"Читаю {len(sheet_names)} листов в файле.")
+            weeks = read_weeks(xls, sheet_names, self.links)
+        return {split_parity(name): week for name, week in weeks.items()}
+
+    async def _run(self, func, *args):
+        if self.pool is None:
+            return func(*args)
+        return await self.pool.run(func, *args)
+
+    async def preparse(self, stored: StoredFile) -> int:
+        """Кладёт в кэш недели всех листов файла. Возвращает число листов."""
+        if self.pool is None:
+            weeks = self.parse_workbook(stored.path)
+        else:
+            # Листы делятся между процессами пула
+            sheet_names = await asyncio.to_thread(list_known_sheets, stored.path)
+            print(f"Читаю {len(sheet_names)} листов в файле.")
+            chunks = [chunk for chunk in (sheet_names[i::self.pool.workers] for i in range(self.pool.workers)) if chunk]
+            parts = await asyncio.gather(*(self.pool.run(parse_sheets_job, stored.path, chunk, self.links) for chunk in chunks))
+            weeks = {split_parity(name): Week.unpack(packed) for part in parts for name, packed in part.items()}
+        for (sheet_name, even_week), week in weeks.items():
+            self.weeks.put((stored.sha256, sheet_name, even_week), week)
+        self._preparsed.add(stored.sha256)
+        return len(weeks)
+
+    async def get_week(self, stored: StoredFile, sheet_name: str, even_week=None):
+        key = (stored.sha256, sheet_name, even_week)
+        week = self.weeks.get(key)
+        if week is not None:
+            return week
+        if self.cache_settings.get("preparse", True) and sheet_name in KnownSheets and stored.sha256 not in self._preparsed:
+            # Один разбор книги обслужит и остальные чаты, которые смотрят в этот файл
+            try:
+                await self.parses.do(stored.sha256, self.preparse, stored)
+            except Exception as e:
+                print(f"WARN: Не удалось разобрать книгу целиком: {e!r}. Читаю только лист {sheet_name!r}.")
+            week = self.weeks.get(key)
+            if week is not None:
+                return week
+        week, _waiters = await self.parses.do(key, self._parse_one, stored, sheet_name, even_week)
+        return week
+
+    async def _parse_one(self, stored: StoredFile, sheet_name: str, even_week) -> Week | str:
+        week = await self._run(parse_sheet_job, stored.path, with_parity(sheet_name, even_week), self.links)
+        if isinstance(week, str):
+            return week
+        week = Week.unpack(week)
+        self.weeks.put((stored.sha256, sheet_name, even_week), week)
+        return week
+
+    async def get_data(self, chat: ChatConfig, even_week: bool):
+        stored = await self.download(chat, even_week)
+        if stored is None:
             return None
-        return self.parse_xml(chat, file_path, even_week)
+        return await self.get_week(stored, chat.sheet_name, even_week)
+
+
+def teacher_link(teacher: str, links: dict[str, str]) -> str | None:
+    # Ссылки ищутся по фамилии преподавателя
+    return links.get(teacher.split(" ")[0].lower(), None)
+
+
+def known_sheets(xls: pd.ExcelFile) -> list[str]:
+    return [name for name in xls.sheet_names if split_parity(name)[0] in KnownSheets]
+
+
+def read_weeks(xls: pd.ExcelFile, sheet_names: list[str], links: dict[str, str]) -> dict[str, Week]:
+    # Ошибка в одном листе не должна лишать расписания чаты с другими листами этого файла
+    weeks = {}
+    for name in sheet_names:
+        try:
+            weeks[name] = Parser.read_week(xls, name, links)
+        except Exception as e:
+            print(f"WARN: Лист {name!r} не разобран: {e!r}")
+    return weeks
+
+
+def list_known_sheets(file_path) -> list[str]:
+    with Parser.open_workbook(file_path) as xls:
+        return known_sheets(xls)
+
+
+def parse_sheet(file_path, sheet_name: str, links: dict[str, str]) -> Week | str:
+    print(f"Читаю {sheet_name!r} в файле.")
+    with Parser.open_workbook(file_path) as xls:
+        sheet_names = xls.sheet_names
+        if sheet_name not in sheet_names:
+            return f"\nЛист `{sheet_name}` не доступен. Доступные листы: \n{'\n'.join(sheet_names)}\n"
+        return Parser.read_week(xls, sheet_name, links)
+
+
+# Задачи для пула процессов: недели возвращаются в упакованном виде, см. Week.pack
+
+def parse_sheet_job(file_path, sheet_name: str, links: dict[str, str]) -> tuple | str:
+    week = parse_sheet(file_path, sheet_name, links)
+    return week.pack() if isinstance(week, Week) else week
+
 
+def parse_sheets_job(file_path, sheet_names: list[str], links: dict[str, str]) -> dict[str, tuple]:
+    # Книгу открываем заново в процессе: её нельзя передать между процессами
+    with Parser.open_workbook(file_path) as xls:
+        return {name: week.pack() for name, week in read_weeks(xls, sheet_names, links).items()}
@@ -1,9 +1,17 @@
 import asyncio
 import datetime
+import heapq
 import inspect
-from dataclasses import dataclass, field
+import itertools
+import time
+import zlib
+from collections import defaultdict
+from dataclasses import dataclass, field, replace
+from pathlib import Path
 from zoneinfo import ZoneInfo
 
+from .journal import TaskJournal
+
 available_days = [
     "monday",
     "tuesday",
@@ -20,7 +28,72 @@ available_modes = [
     "every"
 ]
 
-@dataclass
+every_day = 0b1111111
+
+
+@dataclass(frozen=True, slots=True)
+class Rule:
+    """Разобранное правило задачи. Строка правила разбирается один раз, при добавлении задачи."""
+    mode: str
+    weekdays: int = 0  # every: битовая маска дней недели, бит 0 - понедельник
+    date: datetime.date | None = None  # once: дата
+    seconds: int = 0  # Время срабатывания в секундах от начала дня
+    next_at: datetime.datetime | None = None  # Ближайшее срабатывание
+
+    @classmethod
+    def parse(cls, rule: str, date_pattern: str = "%d.%m.%Y", time_pattern: str = "%H:%M:%S") -> "Rule":
+        parts = rule.split("|")
+        if len(parts) != 3:
+            raise ValueError("Rule must have 3 parts separated by |")
+        mode, day, at = parts
+        if mode not in available_modes:
+            raise ValueError(f"Mode must be one of {available_modes}")
+        if mode == "now":
+            return cls(mode)
+        try:
+            t = datetime.datetime.strptime(at, time_pattern).time()
+        except ValueError:
+            raise ValueError(f"Time ({at}) must be in format {time_pattern}")
+        seconds = t.hour * 3600 + t.minute * 60 + t.second
+        if mode == "every":
+            if day == "none":
+                return cls(mode, weekdays=every_day, seconds=seconds)
+            if day.lower() not in available_days:
+                raise ValueError(f"Day must be one of {available_days} or none")
+            return cls(mode, weekdays=1 << available_days.index(day.lower()), seconds=seconds)
+        try:
+            date = datetime.datetime.strptime(day, date_pattern).date()
+        except ValueError:
+            raise ValueError(f"Day ({day}) must be in format {date_pattern}")
+        return cls(mode, date=date, seconds=seconds)
+
+    @property
+    def time(self) -> datetime.time:
+        return datetime.time(self.seconds // 3600, self.seconds // 60 % 60, self.seconds % 60)
+
+    def next_time(self, now: datetime.datetime, timezone: ZoneInfo) -> datetime.datetime | None:
+        """Ближайшее время срабатывания не раньше now; None - задача больше не сработает."""
+        if self.mode == "now":
+            return now
+        if self.mode == "once":
+            at = datetime.datetime.combine(self.date, self.time, tzinfo=timezone)
+            return at if at >= now else None
+        now = now.astimezone(timezone)
+        for days in range(8):
+            day = now.date() + datetime.timedelta(days=days)
+            if not self.weekdays & (1 << day.weekday()):
+                continue
+            at = datetime.datetime.combine(day, self.time, tzinfo=timezone)
+            if at > now:
+                return at
+        return None
+
+    def planned(self, now: datetime.datetime, timezone: ZoneInfo) -> "Rule":
+        return replace(self, next_at=self.next_time(now, timezone))
+
+
+# eq=False: задачи сравниваются и хэшируются по identity, чтобы лежать в индексах планировщика
+@dataclass(slots=True, eq=False)
 class Task:
     name: str
     callback: callable
@@ -34,77 +107,88 @@ class Task:
     # If mode is now, then day and time are not checked
     rule: str = None
     ready: bool = False
+    owner: int | None = None  # id чата, которому принадлежит задача
+    kind: str = "system"  # day, lesson, system
+    # Ссылка на данные задачи (файл, лист, день, пара). Задачи с payload сохраняются в журнал
+    # и после перезапуска вызываются как callbacks[kind](owner, payload)
+    payload: dict | None = None
+    id: int | None = None  # id в журнале
     timezone: ZoneInfo = field(default=ZoneInfo("UTC"))
     time_pattern: str = "%H:%M:%S"
     date_pattern: str = "%d.%m.%Y"
+    compiled: Rule | None = field(default=None, repr=False)
+    target: float | None = field(default=None, repr=False)  # compiled.next_at в виде timestamp
+    jitter: float = field(default=0, repr=False)  # Сдвиг срабатывания внутри окна, секунды
+    due: float | None = field(default=None, repr=False)  # target + jitter, по нему задача лежит в куче
+    delay: float | None = field(default=None, repr=False)  # На сколько последний запуск опоздал относительно target
 
     def set_time_settings(self, info: "SchedulerSettings"):
         self.timezone = info.timezone
         self.time_pattern = info.time_pattern
         self.date_pattern = info.date_pattern
 
-    def check(self):
-        if len(self.rule.split("|")) != 3:
-            raise ValueError("Rule must have 3 parts separated by |")
-        if self.mode not in available_modes:
-            raise ValueError(f"Mode must be one of {available_modes}")
-        if self.expired():
+    def check(self, now: datetime.datetime = None):
+        self.compiled = Rule.parse(self.rule, self.date_pattern, self.time_pattern)
+        if self.expired(now):
             self.ready = True
             print(f"WARN: Задача уже просрочена; {self}")
-        _day = self.rule.split("|")[1]
-        if self.mode == "every":
-            if _day not in available_days and _day != "none":
-                raise ValueError(f"Day must be one of {available_days} or none")
-        else:
-            try:
-                datetime.datetime.strptime(_day, self.date_pattern)
-            except ValueError:
-                raise ValueError(f"Day ({_day}) must be in format {self.date_pattern}")
-        try:
-            datetime.datetime.strptime(self.rule.split("|")[2], self.time_pattern)
-        except ValueError:
-            raise ValueError(f"Time ({self.rule.split("|")[2]}) must be in format {self.time_pattern}")
 
     @property
     def mode(self):
-        return self.rule.split("|")[0]
+        return self.compiled.mode
 
     @property
     def date(self):
-        if self.mode == "every":
-            return self.rule.split("|")[1]
-        return datetime.datetime.strptime(self.rule.split("|")[1], "%d.%m.%Y").date()
+        if self.compiled.mode == "every":
+            if self.compiled.weekdays == every_day:
+                return "none"
+            return available_days[self.compiled.weekdays.bit_length() - 1]
+        return self.compiled.date
 
     @property
     def time(self):
-        return datetime.datetime.strptime(self.rule.split("|")[2], "%H:%M:%S").time()
+        return self.compiled.time
+
+    @property
+    def next_at(self) -> datetime.datetime | None:
+        return self.compiled.next_at
 
     def get_rule(self):
         return self.mode, self.date, self.time
 
-    def expired(self):
+    def plan(self, now: datetime.datetime) -> bool:
+        """Считает следующее срабатывание не раньше now. False - задача больше не сработает."""
+        self.compiled = self.compiled.planned(now, self.timezone)
+        if self.compiled.next_at is None:
+            self.ready = True
+            self.due = None
+            return False
+        self.target = self.compiled.next_at.timestamp()
+        self.due = self.target + self.jitter
+        return True
+
+    def expired(self, now: datetime.datetime = None):
         if self.ready:
             return True
         if not self.rule:
             return True
-        mode, date, time = self.get_rule()
-        if mode == "once":
-            today = datetime.datetime.now().astimezone(self.timezone)
-            if today.date() > date:
-                return True
-            if date == today.date():
-                if today.time() > time:
-                    return True
+        if self.compiled.mode == "once":
+            now = now or datetime.datetime.now(self.timezone)
+            return self.compiled.next_time(now, self.timezone) is None
         return False
 
+    def to_row(self) -> tuple:
+        rule = self.compiled
+        return (self.id, self.name, self.owner, self.kind, self.rule, rule.mode, rule.weekdays,
+                rule.date.toordinal() if rule.date else None, rule.seconds, self.payload)
+
     def __str__(self):
         return f"Task({self.name!r}; {self.rule!r}; {self.ready};)"
 
     async def run(self):
+        # Когда запускать, решает планировщик; здесь только защита от повторного запуска
         if self.ready:
             return False, None
-        if self.expired():
-            return False, None
         try:
             if inspect.iscoroutinefunction(self.callback):
                 callback_data = await self.callback(*self.args, **self.kwargs)
@@ -124,6 +208,10 @@ class SchedulerSettings:
     time_pattern: str = "%H:%M:%S"
     date_pattern: str = "%d.%m.%Y"
     prune_rule: str = "every|none|00:00:00"
+    journal: str | None = None  # Файл SQLite с задачами; None - задачи живут только в памяти
+    jitter: int = 0  # Окно в секундах после срока, по которому разносятся задачи чатов; 0 - без разноса
+    catch_up: int = 300  # Опоздавшая на столько секунд задача ещё выполняется, дальше - пропускается
+    max_concurrent: int = 10  # Сколько задач выполняется одновременно
 
     def __post_init__(self):
         if isinstance(self.timezone, str):
@@ -131,68 +219,273 @@ class SchedulerSettings:
 
 
 class Scheduler:
+    """
+    Задачи лежат в куче по времени срабатывания. Цикл спит до ближайшего срока
+    и просыпается раньше, только если добавили задачу, которая должна сработать раньше.
+    """
+    max_sleep = 60  # Периодически сверяемся с часами: сон идёт по monotonic, сроки - по времени системы
+
     def __init__(self, settings: SchedulerSettings, loop: asyncio.AbstractEventLoop):
         self.run = True
         self.loop = loop
         self.settings = settings
-        self.lock = asyncio.Lock()
-        self.tasks: list[Task] = []
+        self.slots = asyncio.Semaphore(settings.max_concurrent)
+        self._running: set[asyncio.Task] = set()  # Выполняющиеся задачи; ссылки держим, чтобы их не собрал GC
+        # Упорядоченные множества задач: все, по чатам и по видам
+        self._tasks: dict[Task, None] = {}
+        self._by_owner: dict[int | None, dict[Task, None]] = defaultdict(dict)
+        self._by_kind: dict[str, dict[Task, None]] = defaultdict(dict)
         self.t = None
-        self.notified = False
+        self._heap: list[tuple[float, int, Task]] = []
+        self._seq = itertools.count()  # При равных сроках задачи выполняются в порядке добавления
+        self._wakeup = asyncio.Event()
+        self.callbacks: dict[str, callable] = {}
+        self.journal = TaskJournal(Path(settings.journal)) if settings.journal else None
+        self.fired = 0
+        self.missed = 0
+        self.total_delay = 0.0
+        self.max_delay = 0.0
+
+    def register(self, kind: str, callback: callable):
+        """Функция для задач вида kind, восстановленных из журнала."""
+        self.callbacks[kind] = callback
+
+    @property
+    def tasks(self) -> list[Task]:
+        return list(self._tasks)
+
+    def tasks_for(self, owner: int | None) -> list[Task]:
+        return list(self._by_owner.get(owner, ()))
+
+    def count_by_owner(self) -> dict[int | None, int]:
+        return {owner: len(tasks) for owner, tasks in self._by_owner.items()}
+
+    def count_by_kind(self) -> dict[str, int]:
+        return {kind: len(tasks) for kind, tasks in self._by_kind.items()}
+
+    def _register(self, task: Task):
+        self._tasks[task] = None
+        self._by_owner[task.owner][task] = None
+        self._by_kind[task.kind][task] = None
+
+    def _unregister(self, task: Task):
+        self._tasks.pop(task, None)
+        for index, key in ((self._by_owner, task.owner), (self._by_kind, task.kind)):
+            bucket = index.get(key)
+            if bucket is not None:
+                bucket.pop(task, None)
+                if not bucket:
+                    del index[key]
+
+    def now(self) -> datetime.datetime:
+        return datetime.datetime.now(self.settings.timezone)
+
+    def _jitter(self, task: Task) -> float:
+        return self._owner_jitter(task.owner)
+
+    def _owner_jitter(self, owner: int | None) -> float:
+        # Сдвиг зависит только от чата: уведомления одного чата не меняют порядок и не скачут между перезапусками
+        if not self.settings.jitter or owner is None:
+            return 0
+        return zlib.crc32(str(owner).encode()) % (self.settings.jitter * 1000) / 1000
+
+    def _schedule(self, task: Task, now: datetime.datetime) -> bool:
+        if not task.plan(now):
+            return False
+        if not self._heap or task.due < self._heap[0][0]:
+            self._wakeup.set()
+        heapq.heappush(self._heap, (task.due, next(self._seq), task))
+        return True
 
     def add_task(self, *tasks: Task):
+        now = self.now()
+        persist = []
         for task in tasks:
             if not isinstance(task, Task):
                 raise ValueError("Task must be an instance of Task")
             task.set_time_settings(self.settings)
-            task.check()
+            task.jitter = self._jitter(task)
+            task.check(now)  # Правило разбирается здесь и больше не парсится
             if task.ready:
                 continue
+            if not self._schedule(task, now):
+                continue
             print(f"Задача {task.name!r} добавлена в планировщик. Правило: {task.get_rule()!r}")
-            self.tasks.append(task)
-
-    async def tick(self, *_, **__):
-        if not self.notified:
-            print("Планировщик запущен")
-            self.notified = True
-        today = datetime.datetime.now().astimezone(self.settings.timezone)
-        async with self.lock:
-            for task in self.tasks.copy():
-                if task.expired():
-                    return
-                mode, date, time = task.get_rule()
-                if mode == "now":
-                    return await task.run()
-                if time != today.time():
-                    return
-                if mode == "every":
-                    if date != "none":
-                        if date.lower() != available_days[today.weekday()]:
-                            return
-                if mode == "once":
-                    if date != today.date():
-                        return
-                return await task.run()
+            self._register(task)
+            if self.journal is not None and task.payload is not None:
+                task.id = self.journal.new_id()
+                persist.append(task.to_row())
+        if persist:
+            self.journal.add(persist)
+
+    def restore(self) -> int:
+        """Загружает задачи из журнала. Правила уже разобраны, файлы расписаний не читаются."""
+        if self.journal is None:
+            return 0
+        start = time.perf_counter()
+        # Задачи, проспавшие не больше catch_up, ещё успеют выполниться
+        now = self.now() - datetime.timedelta(seconds=self.settings.catch_up)
+        settings = self.settings
+        dead = []
+        # У тысяч задач всего несколько десятков разных правил (дата и время пары): правило неизменяемо,
+        # поэтому срок считается один раз на правило, а Rule делится между задачами без plan() и replace()
+        planned: dict[tuple, tuple[Rule, float] | None] = {}
+        jitters: dict[int | None, float] = {}
+        for task_id, name, owner, kind, rule, mode, weekdays, date, seconds, payload in self.journal.load():
+            callback = self.callbacks.get(kind)
+            if callback is None:
+                dead.append(task_id)
+                continue
+            key = (mode, weekdays, date, seconds)
+            if key not in planned:
+                compiled = Rule(mode, weekdays, datetime.date.fromordinal(date) if date else None, seconds).planned(now, settings.timezone)
+                planned[key] = (compiled, compiled.next_at.timestamp()) if compiled.next_at is not None else None
+            if planned[key] is None:
+                # Срок прошёл, пока бот был выключен
+                dead.append(task_id)
+                continue
+            compiled, target = planned[key]
+            jitter = jitters.get(owner)
+            if jitter is None:
+                jitter = jitters[owner] = self._owner_jitter(owner)
+            task = Task(name, callback, args=(owner, payload), rule=rule, owner=owner, kind=kind, payload=payload, id=task_id,
+                        timezone=settings.timezone, time_pattern=settings.time_pattern, date_pattern=settings.date_pattern,
+                        compiled=compiled, target=target, jitter=jitter, due=target + jitter)
+            self._heap.append((task.due, next(self._seq), task))
+            self._register(task)
+        heapq.heapify(self._heap)
+        self._wakeup.set()
+        if dead:
+            self.journal.remove(*dead)
+        print(f"Восстановлено задач: {len(self._tasks)} за {(time.perf_counter() - start) * 1000:.0f}мс; просрочено: {len(dead)}")
+        return len(self._tasks)
+
+    def cancel_owner(self, owner: int) -> int:
+        """Снимает все задачи чата за время, пропорциональное их числу. Записи в куче отбрасываются при извлечении."""
+        tasks = self._by_owner.pop(owner, {})
+        for task in tasks:
+            task.ready = True
+            self._unregister(task)
+        if tasks and self.journal is not None:
+            self.journal.remove_owner(owner)
+        return len(tasks)
+
+    def cancel(self, *tasks: Task):
+        """Снимает отдельные задачи; остальные задачи владельца не трогаются."""
+        for task in tasks:
+            task.ready = True
+            self._unregister(task)
+        if self.journal is not None:
+            self.journal.remove(*(task.id for task in tasks if task.id is not None))
+
+    def update_payloads(self, owner: int, where: dict, **changes) -> int:
+        """Меняет поля payload у задач чата, payload которых содержит where; например ссылку на новую версию файла."""
+        rows = []
+        for task in self._by_owner.get(owner, ()):
+            if task.payload is None or any(task.payload.get(k) != v for k, v in where.items()):
+                continue
+            task.payload = {**task.payload, **changes}
+            task.args = (owner, task.payload)
+            if task.id is not None:
+                rows.append(task.to_row())
+        if rows and self.journal is not None:
+            self.journal.add(rows)
+        return len(rows)
+
+    def replace_owner(self, owner: int, tasks: list[Task]) -> int:
+        self.cancel_owner(owner)
+        self.add_task(*tasks)
+        return len(self._by_owner.get(owner, ()))
+
+    def _run_due(self):
+        # Каждая задача - отдельная asyncio задача: медленный обработчик не задерживает следующие сроки,
+        # а одновременно выполняется не больше max_concurrent (см. _fire)
+        now = time.time()
+        while self._heap and self._heap[0][0] <= now:
+            due, _, task = heapq.heappop(self._heap)
+            if task.ready or task.due != due:
+                # Задачу сняли или перенесли
+                continue
+            running = asyncio.ensure_future(self._fire(task))
+            self._running.add(running)
+            running.add_done_callback(self._running.discard)
+
+    async def _fire(self, task: Task):
+        target = task.target
+        late = time.time() - target
+        if late > self.settings.catch_up + task.jitter:
+            # Бот спал или цикл был занят: старое уведомление уже не нужно
+            self.missed += 1
+            print(f"WARN: Задача пропущена, опоздание {late:.0f}с; {task}")
+            if task.mode != "every":
+                task.ready = True
+        else:
+            async with self.slots:
+                task.delay = time.time() - target
+                ok, data = await task.run()
+            self.fired += 1
+            self.total_delay += task.delay
+            self.max_delay = max(self.max_delay, task.delay)
+            if not ok and isinstance(data, Exception):
+                print(f"ERR: Задача завершилась с ошибкой; {task}: {data!r}")
+                if task.mode != "every":
+                    # Повторять не будем: иначе задача навсегда останется в индексах и журнале без места в куче
+                    task.ready = True
+        if task.mode == "every" and not task.ready:
+            # Следующий запуск считаем от текущего срока, чтобы не сработать дважды в ту же секунду
+            self._schedule(task, datetime.datetime.fromtimestamp(max(target, time.time()) + 1, self.settings.timezone))
+        if task.ready:
+            self._unregister(task)
+            if task.id is not None and self.journal is not None:
+                self.journal.remove(task.id)
 
     async def _ticker(self):
         while self.run:
-            await asyncio.sleep(0.7)
-            await self.tick()
+            self._run_due()
+            timeout = self.max_sleep
+            if self._heap:
+                timeout = min(max(self._heap[0][0] - time.time(), 0), self.max_sleep)
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except TimeoutError:
+                pass
         print("Планировщик остановлен")
 
     def _prune(self):
-        self.tasks = [task for task in self.tasks if not task.ready]
+        done = [task for task in self._tasks if task.ready]
+        for task in done:
+            self._unregister(task)
+        if self.journal is not None:
+            self.journal.remove(*(task.id for task in done if task.id is not None))
+        self._heap = [entry for entry in self._heap if not entry[2].ready and entry[2].due == entry[0]]
+        heapq.heapify(self._heap)
 
     def add_prune_task(self):
         t = Task("Очистка планировщика", self._prune, rule=self.settings.prune_rule)
         self.add_task(t)
 
     async def start(self):
+        self.restore()
         self.add_prune_task()
+        print("Планировщик запущен")
         await self._ticker()
 
     async def stop(self):
         print("Остановка планировщика...")
         self.run = False
+        self._wakeup.set()
         if self.t:
             await asyncio.gather(self.t)
+        if self._running:
+            # Даём начатым отправкам закончиться, но не ждём бесконечно
+            _done, pending = await asyncio.wait(self._running, timeout=10)
+            for running in pending:
+                running.cancel()
+        if self.journal is not None:
+            self.journal.close()
+
+    def __str__(self):
+        avg = self.total_delay / self.fired if self.fired else 0
+        return (f"Scheduler(задач: {len(self._tasks)}; выполняется: {len(self._running)}; выполнено: {self.fired}; пропущено: {self.missed}; "
+                f"задержка: сред. {avg:.1f}с, макс. {self.max_delay:.1f}с)")
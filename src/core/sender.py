@@ -0,0 +1,159 @@
+import asyncio
+import itertools
+import time
+from dataclasses import dataclass, field
+from datetime import timedelta
+from typing import Any
+
+from telegram import Bot
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError
+
+INTERACTIVE = 0  # Ответы на команды
+BULK = 1  # Уведомления планировщика
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate = rate  # Токенов в секунду
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def reserve(self) -> float:
+        """Забирает токен в долг; возвращает, сколько секунд подождать до отправки."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def idle(self) -> bool:
+        return self.tokens + (time.monotonic() - self.updated) * self.rate >= self.capacity
+
+
+@dataclass(order=True)
+class Outgoing:
+    priority: int
+    seq: int
+    chat_id: int = field(compare=False)
+    kwargs: dict[str, Any] = field(compare=False)
+    future: asyncio.Future | None = field(default=None, compare=False)
+
+
+class Sender:
+    """
+    Очередь исходящих сообщений с ограничениями Telegram: общий лимит на бота,
+    отдельный на каждый чат (группы - строже) и паузы по RetryAfter.
+    Ответы на команды идут вперёд уведомлений.
+    """
+    max_buckets = 1000  # Сверх этого бездействующие лимиты чатов забываются
+
+    def __init__(self, bot: Bot, rate: float = 30, chat_rate: float = 1, group_per_minute: float = 20,
+                 workers: int = 4, queue_size: int = 1000, max_retries: int = 3):
+        self.bot = bot
+        self.workers = workers
+        self.max_retries = max_retries
+        self.chat_rate = chat_rate
+        self.group_rate = group_per_minute / 60
+        self.bucket = TokenBucket(rate, rate)
+        self.chat_buckets: dict[int, TokenBucket] = {}
+        self.paused_until = 0.0
+        self.queue: asyncio.PriorityQueue[Outgoing] = asyncio.PriorityQueue()
+        # Ограничиваем только уведомления: ответ на команду не должен ждать места в очереди
+        self._bulk_slots = asyncio.Semaphore(queue_size)
+        self._seq = itertools.count()
+        self._workers: list[asyncio.Task] = []
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+
+    def start(self):
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float = 10):
+        # Даём дослать то, что уже в очереди
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except TimeoutError:
+            print(f"WARN: Не отправлено сообщений: {self.queue.qsize()}.")
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+
+    async def send(self, chat_id: int, text: str, parse_mode: str = None, priority: int = BULK, wait: bool = False, **kwargs):
+        """
+        Ставит сообщение в очередь. wait=True - дождаться отправки и вернуть Message
+        (ошибка Telegram пробрасывается), иначе ошибки только печатаются.
+        """
+        future = asyncio.get_running_loop().create_future() if wait else None
+        if priority != INTERACTIVE:
+            await self._bulk_slots.acquire()
+        await self.queue.put(Outgoing(priority, next(self._seq), chat_id, {"text": text, "parse_mode": parse_mode, **kwargs}, future))
+        if future is not None:
+            return await future
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) >= self.max_buckets:
+                self.chat_buckets = {k: v for k, v in self.chat_buckets.items() if not v.idle()}
+            # У групп и каналов отрицательные id
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.group_rate if chat_id < 0 else self.chat_rate)
+        return bucket
+
+    def _wait(self, chat_id: int) -> float:
+        return max(self.bucket.reserve(), self._chat_bucket(chat_id).reserve(), self.paused_until - time.monotonic())
+
+    async def _worker(self):
+        while True:
+            item = await self.queue.get()
+            try:
+                await self._deliver(item)
+            finally:
+                self.queue.task_done()
+                if item.priority != INTERACTIVE:
+                    self._bulk_slots.release()
+
+    async def _deliver(self, item: Outgoing):
+        error = None
+        for attempt in range(self.max_retries + 1):
+            if item.future is not None and item.future.cancelled():
+                return
+            await asyncio.sleep(self._wait(item.chat_id))
+            try:
+                message = await self.bot.send_message(chat_id=item.chat_id, **item.kwargs)
+            except RetryAfter as e:
+                delay = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after
+                # Flood control распространяется на весь бот, поэтому ждут все
+                self.paused_until = max(self.paused_until, time.monotonic() + delay)
+                print(f"WARN: Telegram просит подождать {delay}с; чат {item.chat_id}.")
+                error = e
+            except BadRequest as e:
+                error = e
+                break
+            except NetworkError as e:
+                await asyncio.sleep(2 ** attempt)
+                error = e
+            except TelegramError as e:
+                error = e
+                break
+            except Exception as e:
+                # Не ошибка Telegram (например, в самом клиенте): обработчик очереди должен жить дальше
+                error = e
+                break
+            else:
+                self.sent += 1
+                if item.future is not None and not item.future.done():
+                    item.future.set_result(message)
+                return
+            if attempt < self.max_retries:
+                self.retried += 1
+        self.failed += 1
+        if item.future is not None and not item.future.done():
+            item.future.set_exception(error)
+        else:
+            print(f"ERR: Сообщение в чат {item.chat_id} не отправлено: {error!r}")
+
+    def __str__(self):
+        return (f"Sender(в очереди: {self.queue.qsize()}; отправлено: {self.sent}; повторов: {self.retried}; "
+                f"ошибок: {self.failed}; чатов: {len(self.chat_buckets)})")
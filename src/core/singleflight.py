@@ -0,0 +1,46 @@
+import asyncio
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Hashable
+
+
+@dataclass
+class Flight:
+    task: asyncio.Future
+    waiters: int = 1
+
+
+class SingleFlight:
+    """Склеивает одновременные вызовы с одинаковым ключом в один."""
+
+    def __init__(self, name: str = "single-flight"):
+        self.name = name
+        self.flights: dict[Hashable, Flight] = {}
+        self.total = 0  # Сколько раз реально выполнялась функция
+        self.shared = 0  # Сколько вызовов получили чужой результат
+
+    async def do(self, key: Hashable, func: Callable[..., Awaitable[Any]], *args, **kwargs) -> tuple[Any, int]:
+        """
+        Выполняет func(*args, **kwargs) один раз на ключ.
+        Возвращает результат и число вызовов, которые он обслужил.
+        """
+        flight = self.flights.get(key)
+        if flight is None:
+            # Отдельная задача: отмена одного из ожидающих не отменяет загрузку для остальных
+            flight = Flight(asyncio.ensure_future(func(*args, **kwargs)))
+            self.flights[key] = flight
+            self.total += 1
+            flight.task.add_done_callback(lambda _: self._done(key, flight))
+        else:
+            flight.waiters += 1
+            self.shared += 1
+        result = await asyncio.shield(flight.task)
+        return result, flight.waiters
+
+    def _done(self, key: Hashable, flight: Flight):
+        if self.flights.get(key) is flight:
+            del self.flights[key]
+        if flight.waiters > 1:
+            print(f"{self.name}: {key!r} обслужил {flight.waiters} запросов.")
+
+    def __str__(self):
+        return f"SingleFlight({self.name!r}; в процессе: {len(self.flights)}; выполнено: {self.total}; склеено: {self.shared})"
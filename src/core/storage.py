@@ -0,0 +1,210 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+
+class StorageError(Exception):
+    pass
+
+
+def write_atomic(path: Path, text: str):
+    # Сначала во временный файл: при падении посреди записи старый файл останется целым
+    tmp_path = path.with_name(path.name + ".tmp")
+    tmp_path.write_text(text, "utf-8")
+    os.replace(tmp_path, path)
+
+
+def read_json(path: Path, what: str) -> dict:
+    if not path.exists():
+        raise StorageError(f"Файл с {what} не найден: {path}")
+    try:
+        return json.loads(path.read_text("utf-8"))
+    except json.JSONDecodeError:
+        raise StorageError(f"Файл с {what} поврежден: {path}") from None
+
+
+class JsonStorage:
+    """Чаты, ссылки и шаблоны в трёх JSON файлах. Любое изменение переписывает файл целиком."""
+
+    def __init__(self, chats_path: Path, links_path: Path, templates_path: Path):
+        self.chats_path = chats_path
+        self.links_path = links_path
+        self.templates_path = templates_path
+        # Чат -> строка JSON: при сохранении заново сериализуются только изменённые чаты
+        self._encoded: dict[int, str] = {}
+        # Чаты пишутся и перечитываются из потоков
+        self._lock = threading.Lock()
+        # (mtime, size) после собственной записи и последняя версия, записанная кем-то другим:
+        # свои записи не должны выглядеть для StoreWatcher как изменения
+        self._written: dict[str, tuple[int, int]] = {}
+        self._external: dict[str, tuple[int, int] | None] = {}
+
+    def load_chats(self) -> dict[int, dict]:
+        if not self.chats_path.exists():
+            write_atomic(self.chats_path, "{}")
+            print(f"Файл с настройками чатов создан: {self.chats_path}.")
+        with self._lock:
+            chats = {int(k): v for k, v in read_json(self.chats_path, "чатами").items()}
+            self._encoded = {k: json.dumps(v, ensure_ascii=False) for k, v in chats.items()}
+        return chats
+
+    def save_chats(self, chats: dict[int, dict | None]):
+        """chats - изменённые чаты; None - удалить чат."""
+        with self._lock:
+            for chat_id, data in chats.items():
+                if data is None:
+                    self._encoded.pop(chat_id, None)
+                else:
+                    self._encoded[chat_id] = json.dumps(data, ensure_ascii=False)
+            # Один чат - одна строка
+            write_atomic(self.chats_path, "{\n" + ",\n".join(f"    {json.dumps(str(k))}: {v}" for k, v in self._encoded.items()) + "\n}\n")
+            self._remember_write("chats")
+
+    def replace_chats(self, chats: dict[int, dict]):
+        with self._lock:
+            self._encoded.clear()
+        self.save_chats(chats)
+
+    def _stat(self, kind: str) -> tuple[int, int] | None:
+        try:
+            st = getattr(self, f"{kind}_path").stat()
+        except FileNotFoundError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def _remember_write(self, kind: str):
+        # Вызывается под self._lock сразу после записи
+        self._external.setdefault(kind, None)
+        self._written[kind] = self._stat(kind)
+
+    def version(self, kind: str) -> tuple[int, int] | None:
+        """Меняется, когда файл kind (chats, links, templates) переписан не этим экземпляром."""
+        with self._lock:
+            stat = self._stat(kind)
+            if kind in self._written and stat == self._written[kind]:
+                return self._external[kind]
+            self._external[kind] = stat
+            return stat
+
+    def load_links(self) -> dict[str, str]:
+        return read_json(self.links_path, "ссылками")
+
+    def save_links(self, links: dict[str, str]):
+        with self._lock:
+            write_atomic(self.links_path, json.dumps(links, ensure_ascii=False, indent=4))
+            self._remember_write("links")
+
+    def load_templates(self) -> dict[str, dict]:
+        return read_json(self.templates_path, "шаблонами")
+
+    def save_templates(self, templates: dict[str, dict]):
+        with self._lock:
+            write_atomic(self.templates_path, json.dumps(templates, ensure_ascii=False, indent=4))
+            self._remember_write("templates")
+
+    def close(self):
+        pass
+
+    def __str__(self):
+        return f"JsonStorage({self.chats_path}, {self.links_path}, {self.templates_path})"
+
+
+class SqliteStorage:
+    """
+    Чаты, ссылки и шаблоны в одной базе SQLite (WAL). Изменённые чаты пишутся по одному,
+    у шаблонов хранятся все версии. Базу могут одновременно открывать несколько процессов бота.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Запись чатов идёт из потока, поэтому соединение общее, а доступ - под блокировкой
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS chats (id INTEGER PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS links (teacher TEXT PRIMARY KEY, url TEXT NOT NULL)")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS templates ("
+                " name TEXT NOT NULL,"
+                " version INTEGER NOT NULL,"
+                " data TEXT NOT NULL,"
+                " created_at REAL NOT NULL,"
+                " PRIMARY KEY (name, version)"
+                ")"
+            )
+
+    def _query(self, sql: str, *args) -> list[tuple]:
+        with self._lock:
+            return self.db.execute(sql, args).fetchall()
+
+    def version(self, kind: str) -> int:
+        # data_version меняется только от записей других соединений, то есть других процессов; одно значение на всю базу
+        return self._query("PRAGMA data_version")[0][0]
+
+    def empty(self) -> bool:
+        return not any(self._query(f"SELECT 1 FROM {table} LIMIT 1") for table in ("chats", "links", "templates"))
+
+    def load_chats(self) -> dict[int, dict]:
+        return {chat_id: json.loads(data) for chat_id, data in self._query("SELECT id, data FROM chats")}
+
+    def save_chats(self, chats: dict[int, dict | None]):
+        now = time.time()
+        with self._lock, self.db:
+            self.db.executemany("DELETE FROM chats WHERE id = ?", [(k,) for k, v in chats.items() if v is None])
+            self.db.executemany(
+                "INSERT INTO chats (id, data, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+                [(k, json.dumps(v, ensure_ascii=False), now) for k, v in chats.items() if v is not None]
+            )
+
+    def load_links(self) -> dict[str, str]:
+        return dict(self._query("SELECT teacher, url FROM links"))
+
+    def save_links(self, links: dict[str, str]):
+        with self._lock, self.db:
+            self.db.execute("DELETE FROM links")
+            self.db.executemany("INSERT INTO links (teacher, url) VALUES (?, ?)", links.items())
+
+    def load_templates(self) -> dict[str, dict]:
+        # Последняя версия каждого шаблона
+        rows = self._query("SELECT name, data FROM templates t WHERE version = (SELECT MAX(version) FROM templates WHERE name = t.name) ORDER BY name")
+        return {name: json.loads(data) for name, data in rows}
+
+    def save_templates(self, templates: dict[str, dict]):
+        """Новая версия создаётся только для изменённых шаблонов."""
+        current = self.load_templates()
+        now = time.time()
+        with self._lock, self.db:
+            for name, data in templates.items():
+                if current.get(name) == data:
+                    continue
+                version = self.db.execute("SELECT COALESCE(MAX(version), 0) + 1 FROM templates WHERE name = ?", (name,)).fetchone()[0]
+                self.db.execute("INSERT INTO templates (name, version, data, created_at) VALUES (?, ?, ?, ?)",
+                                (name, version, json.dumps(data, ensure_ascii=False), now))
+
+    def import_from(self, source: JsonStorage) -> str:
+        chats, links, templates = source.load_chats(), source.load_links(), source.load_templates()
+        self.save_chats(chats)
+        self.save_links(links)
+        self.save_templates(templates)
+        return f"Импортировано: чатов {len(chats)}, ссылок {len(links)}, шаблонов {len(templates)}."
+
+    def export_to(self, target: JsonStorage) -> str:
+        chats, links, templates = self.load_chats(), self.load_links(), self.load_templates()
+        target.replace_chats(chats)
+        target.save_links(links)
+        target.save_templates(templates)
+        return f"Экспортировано: чатов {len(chats)}, ссылок {len(links)}, шаблонов {len(templates)}."
+
+    def close(self):
+        with self._lock:
+            self.db.close()
+
+    def __str__(self):
+        return f"SqliteStorage({self.path})"
@@ -0,0 +1,197 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from dataclasses import dataclass, asdict, field
+from pathlib import Path
+from typing import Callable
+
+from .cache import conditional_headers
+
+
+def hash_file(path: Path, chunk_size: int = 65536) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+@dataclass
+class StoredFile:
+    name: str  # Имя файла на сайте или в сообщении
+    sha256: str
+    path: Path = field(repr=False)
+    fetched_at: float = field(default_factory=time.time)  # Когда содержимое последний раз проверялось
+    etag: str | None = None
+    last_modified: str | None = None
+
+    @property
+    def headers(self) -> dict[str, str]:
+        return conditional_headers(self.etag, self.last_modified)
+
+    def to_dict(self):
+        d = asdict(self)
+        del d["path"]
+        return d
+
+
+class FileStore:
+    """
+    Хранилище скачанных .xls по SHA-256 содержимого.
+    Манифест связывает источник (url или файл из Telegram) и чётность с хэшем файла.
+    Время последнего использования файла хранится в его mtime и нужно для LRU-очистки.
+    """
+    manifest_name = "manifest.json"
+
+    def __init__(self, root: Path):
+        self.root = root
+        self.manifest_path = root / self.manifest_name
+        self._manifest: dict[str, StoredFile] = {}
+        # Очистка идёт в отдельном потоке, поэтому манифест меняем только под блокировкой
+        self._lock = threading.Lock()
+        self._protectors: list[Callable[[], set[str]]] = []
+        self._read()
+
+    def _read(self):
+        if not self.manifest_path.exists():
+            return
+        try:
+            for k, v in json.loads(self.manifest_path.read_text("utf-8")).items():
+                self._manifest[k] = StoredFile(path=self.object_path(v["sha256"]), **v)
+        except (json.JSONDecodeError, TypeError, KeyError):
+            print(f"WARN: Манифест загрузок поврежден: {self.manifest_path}. Файлы будут скачаны заново.")
+            self._manifest.clear()
+
+    def _save(self):
+        tmp_path = self.manifest_path.with_name(self.manifest_name + ".tmp")
+        tmp_path.write_text(json.dumps({k: v.to_dict() for k, v in self._manifest.items()}, indent=4), "utf-8")
+        os.replace(tmp_path, self.manifest_path)
+
+    @staticmethod
+    def key(source: str, even_week: bool | None) -> str:
+        return f"{source}#{even_week}"
+
+    def object_path(self, sha256: str) -> Path:
+        return self.root / f"{sha256}.xls"
+
+    def temp_path(self) -> Path:
+        return self.root / f".{uuid.uuid4().hex}.part"
+
+    @staticmethod
+    def _use(path: Path):
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+
+    def get(self, key: str) -> StoredFile | None:
+        with self._lock:
+            entry = self._manifest.get(key)
+            if entry is not None and not entry.path.exists():
+                # Файл удалили руками или его вытеснила очистка
+                del self._manifest[key]
+                self._save()
+                return None
+        if entry is not None:
+            self._use(entry.path)
+        return entry
+
+    def by_hash(self, sha256: str) -> StoredFile | None:
+        path = self.object_path(sha256)
+        if not path.exists():
+            return None
+        with self._lock:
+            entry = next((v for v in self._manifest.values() if v.sha256 == sha256), None)
+        self._use(path)
+        return entry or StoredFile(path.name, sha256, path)
+
+    def touch(self, key: str) -> StoredFile | None:
+        with self._lock:
+            entry = self._manifest.get(key)
+            if entry is not None:
+                entry.fetched_at = time.time()
+                self._save()
+        if entry is not None:
+            self._use(entry.path)
+        return entry
+
+    def commit(self, key: str, name: str, tmp_path: Path, sha256: str,
+               etag: str = None, last_modified: str = None) -> StoredFile:
+        """Переносит временный файл в хранилище; одинаковое содержимое хранится один раз."""
+        path = self.object_path(sha256)
+        with self._lock:
+            if path.exists():
+                tmp_path.unlink()
+                self._use(path)
+            else:
+                os.replace(tmp_path, path)
+            entry = StoredFile(name, sha256, path, time.time(), etag, last_modified)
+            self._manifest[key] = entry
+            self._save()
+        return entry
+
+    def add_file(self, key: str, name: str, tmp_path: Path) -> StoredFile:
+        return self.commit(key, name, tmp_path, hash_file(tmp_path))
+
+    def discard(self, sha256: str):
+        """Удаляет файл и все записи манифеста, которые на него ссылаются."""
+        with self._lock:
+            self._forget(sha256)
+            self._save()
+        path = self.object_path(sha256)
+        if path.exists():
+            path.unlink()
+
+    def _forget(self, *sha256: str):
+        for k in [k for k, v in self._manifest.items() if v.sha256 in sha256]:
+            del self._manifest[k]
+
+    def add_protector(self, protector: Callable[[], set[str]]):
+        """Регистрирует функцию, которая возвращает хэши файлов, которые нельзя удалять."""
+        self._protectors.append(protector)
+
+    def protected(self) -> set[str]:
+        protected = set()
+        for protector in self._protectors:
+            protected |= protector()
+        return protected
+
+    def evict(self, max_bytes: int = 0, max_age: float = 0, protected: set[str] = frozenset()) -> list[Path]:
+        """
+        Удаляет давно не использованные файлы: сначала старше max_age секунд,
+        затем самые старые, пока папка больше max_bytes. 0 - без ограничения.
+        Блокирует поток на время работы с диском, поэтому вызывается через asyncio.to_thread.
+        """
+        now = time.time()
+        files = []
+        for path in self.root.glob("*.xls"):
+            try:
+                st = path.stat()
+            except FileNotFoundError:
+                continue
+            files.append((st.st_mtime, st.st_size, path))
+        files.sort()
+        total = sum(size for _, size, _ in files)
+
+        removed = []
+        for mtime, size, path in files:
+            if path.stem in protected:
+                continue
+            expired = max_age and now - mtime > max_age
+            over_quota = max_bytes and total > max_bytes
+            if not (expired or over_quota):
+                continue
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed.append(path)
+        if removed:
+            with self._lock:
+                self._forget(*(path.stem for path in removed))
+                self._save()
+        return removed
@@ -1,12 +1,59 @@
-import json
+import re
 import sys
 from dataclasses import dataclass
-from pathlib import Path
+from string import Formatter
+from typing import Iterable, Iterator
 
 from core import ChatConfig
+from core.cache import LRUCache
+from core.storage import JsonStorage, SqliteStorage, StorageError
+from core.watcher import diff_keys
 from core.parser import Week, Day, Lesson
 
 
+max_message_len = 4096  # Лимит Telegram на длину сообщения
+# Поля, которые можно использовать в каждой части шаблона
+lesson_fields = frozenset({"i", "lesson_time", "lesson_name", "lesson_teacher", "lesson_place"})
+template_fields = {
+    "header": frozenset({"week_str"}),
+    "day_header": frozenset({"date", "day_name"}),
+    "day_body": lesson_fields,
+    "lesson": lesson_fields,
+    "link_ok": frozenset({"lesson_link"}),
+    "link_none": frozenset(),
+    "no_lessons": frozenset(),
+    "spacing": frozenset(),
+}
+conversions = {None: lambda v: v, "s": str, "r": repr, "a": ascii}
+
+
+class TemplateError(ValueError):
+    pass
+
+
+def compile_format(part: str, s: str, allowed: frozenset[str]) -> tuple[tuple[str, str | None, str | None, str | None], ...]:
+    """Разбирает строку формата один раз: (текст, поле, формат, преобразование) для каждого куска."""
+    try:
+        plan = tuple(Formatter().parse(s))
+    except ValueError as e:
+        raise TemplateError(f"{part}: {e}") from None
+    for _literal, name, spec, conversion in plan:
+        if name is None:
+            continue
+        if name not in allowed:
+            raise TemplateError(f"{part}: неизвестное поле {{{name}}}; доступны: {', '.join(sorted(allowed)) or 'нет'}")
+        if conversion not in conversions or "{" in spec:
+            raise TemplateError(f"{part}: неподдерживаемый формат поля {{{name}}}")
+    return plan
+
+
+def fill(out: list[str], plan: tuple, values: dict[str, object]):
+    for literal, name, spec, conversion in plan:
+        out.append(literal)
+        if name is not None:
+            out.append(format(conversions[conversion](values[name]), spec))
+
+
 @dataclass
 class Template:
     type: str
@@ -20,103 +67,210 @@ class Template:
     spacing: str
     lesson: str
 
-    def render(self, obj, ofo: bool):
+    def __post_init__(self):
+        # Компилируем один раз при загрузке: ошибки в шаблоне видны сразу, а не при первой отправке
+        if len(self.link) != 2:
+            raise TemplateError("link: нужно две строки - со ссылкой и без")
+        if len(self.nums) < 10:
+            raise TemplateError("nums: нужно не меньше 10 номеров пар")
+        parts = {"header": self.header, "day_header": self.day_header, "day_body": self.day_body, "lesson": self.lesson,
+                 "link_ok": self.link[0], "link_none": self.link[1], "no_lessons": self.no_lessons, "spacing": self.spacing}
+        self._plan = {part: compile_format(part, s, template_fields[part]) for part, s in parts.items()}
+        # Все замены одним проходом; длинные ключи раньше, чтобы "ВК" не перебил "ВКС"
+        self._rename = None
+        if self.rename:
+            self._rename = re.compile("|".join(map(re.escape, sorted(self.rename, key=len, reverse=True))))
+        # Строки без полей используются как есть
+        self._spacing = "".join(literal for literal, *_ in self._plan["spacing"])
+        self._link_none = "".join(literal for literal, *_ in self._plan["link_none"])
+        self._no_lessons = "".join(literal for literal, *_ in self._plan["no_lessons"])
+
+    def _renamed(self, s: str | None) -> str | None:
+        if s and self._rename is not None:
+            return self._rename.sub(lambda m: self.rename[m.group()], s)
+        return s
+
+    def _lesson_values(self, lesson: Lesson) -> dict[str, object]:
+        return {
+            "i": self.nums[lesson.num],
+            "lesson_time": lesson.time,
+            "lesson_name": self._renamed(lesson.name),
+            "lesson_teacher": lesson.teacher,
+            "lesson_place": self._renamed(lesson.place),
+        }
+
+    def _link(self, out: list[str], lesson: Lesson):
+        if lesson.link:
+            fill(out, self._plan["link_ok"], {"lesson_link": lesson.link})
+        else:
+            out.append(self._link_none)
+
+    def _blocks(self, obj, ofo: bool) -> Iterator[list[str]]:
+        """
+        Текст по блокам (заголовок недели, день, пара). Блок - список кусков, между которыми
+        можно разрезать сообщение: каждый кусок - целые строки шаблона с закрытыми тегами.
+        """
         if isinstance(obj, Week):
-            return self._render_week(obj, ofo)
-        if isinstance(obj, Day):
-            return self._render_day(obj, ofo)
-        if isinstance(obj, Lesson):
-            return self._render_lesson(obj, ofo)
-        return None
-
-    def _render_week(self, week: Week, ofo: bool):
-        s = self.header.format(week_str=week.date) + self.spacing
-        for day in week.days:
-            if isinstance(day, str):
-                continue
-            s += self._render_day(day, ofo)[0]
-            if day.empty:
-                s += self.spacing
-        return s, self.type
-
-    def _render_day(self, day: Day, ofo: bool):
-        s = self.day_header.format(date=day.date, day_name=day.day_name)
-        for i, lesson in enumerate(day.lessons):
+            out = []
+            fill(out, self._plan["header"], {"week_str": obj.date})
+            out.append(self._spacing)
+            yield ["".join(out)]
+            for day in obj.days:
+                if isinstance(day, str):
+                    continue
+                block = self._day_pieces(day, ofo)
+                if day.empty:
+                    block[-1] += self._spacing
+                yield block
+        elif isinstance(obj, Day):
+            yield self._day_pieces(obj, ofo)
+        elif isinstance(obj, Lesson):
+            out = []
+            self._render_lesson(out, obj, ofo)
+            yield ["".join(out)]
+
+    def render(self, obj, ofo: bool):
+        if not isinstance(obj, (Week, Day, Lesson)):
+            return None
+        return "".join(piece for block in self._blocks(obj, ofo) for piece in block), self.type
+
+    def render_chunks(self, obj, ofo: bool, limit: int = max_message_len) -> Iterator[str]:
+        """Текст частями не длиннее limit; режется между днями, а если день не влезает - между парами."""
+        return pack_chunks(self._blocks(obj, ofo), limit)
+
+    def _day_pieces(self, day: Day, ofo: bool) -> list[str]:
+        out = []
+        fill(out, self._plan["day_header"], {"date": day.date, "day_name": day.day_name})
+        pieces = ["".join(out)]
+        for lesson in day.lessons:
             if lesson.empty:
                 continue
-            for old, new in self.rename.items():
-                lesson.replace(old, new)
-            s += self.day_body.format(
-                i=self.nums[lesson.num],
-                lesson_time=lesson.time,
-                lesson_name=lesson.name,
-                lesson_teacher=lesson.teacher,
-                lesson_place=lesson.place
-            )
-            s += self.spacing
+            out = []
+            fill(out, self._plan["day_body"], self._lesson_values(lesson))
+            out.append(self._spacing)
             if not ofo:
-                if lesson.link:
-                    s += self.link[0].format(lesson_link=lesson.link)
-                else:
-                    s += self.link[1]
-                s += self.spacing
-            s += self.spacing
+                self._link(out, lesson)
+                out.append(self._spacing)
+            out.append(self._spacing)
+            pieces.append("".join(out))
         if day.empty:
-            s += self.no_lessons
-        return s, self.type
-
-    def _render_lesson(self, lesson: Lesson, ofo: bool):
-        s = self.lesson.format(
-            i=self.nums[lesson.num],
-            lesson_time=lesson.time,
-            lesson_name=lesson.name,
-            lesson_teacher=lesson.teacher,
-            lesson_place=lesson.place,
-        )
+            pieces.append(self._no_lessons)
+        return pieces
+
+    def _render_lesson(self, out: list[str], lesson: Lesson, ofo: bool):
+        fill(out, self._plan["lesson"], self._lesson_values(lesson))
         if not ofo:
-            s+= self.spacing
-            if lesson.link:
-                s += self.link[0].format(lesson_link=lesson.link)
-            else:
-                s += self.link[1]
-        return s, self.type
+            out.append(self._spacing)
+            self._link(out, lesson)
+
+
+def split_piece(piece: str, limit: int) -> Iterator[str]:
+    # Кусок длиннее сообщения режем по строкам (теги в шаблонах не переходят через строку), строку - как придётся
+    if len(piece) <= limit:
+        yield piece
+        return
+    line_chunk = ""
+    for line in piece.splitlines(keepends=True):
+        if len(line_chunk) + len(line) > limit and line_chunk:
+            yield line_chunk
+            line_chunk = ""
+        while len(line) > limit:
+            yield line[:limit]
+            line = line[limit:]
+        line_chunk += line
+    if line_chunk:
+        yield line_chunk
+
+
+def pack_chunks(blocks: Iterable[list[str]], limit: int) -> Iterator[str]:
+    chunk, size = [], 0
+
+    def flush():
+        nonlocal chunk, size
+        text = "".join(chunk)
+        chunk, size = [], 0
+        return text
+
+    for block in blocks:
+        block_size = sum(map(len, block))
+        if size + block_size > limit and chunk and block_size <= limit:
+            # Блок целиком влезет в следующее сообщение - не разрываем его
+            yield flush()
+        for piece in block:
+            for part in split_piece(piece, limit):
+                if size + len(part) > limit and chunk:
+                    yield flush()
+                chunk.append(part)
+                size += len(part)
+    if chunk:
+        yield flush()
 
 
 class Templator:
-    def __init__(self, templates_path: Path):
-        self.templates_path = templates_path
+    def __init__(self, storage: JsonStorage | SqliteStorage, cache_size: int = 1024):
+        self.storage = storage
         self.__templates_raw = {}
         self.__templates = {}
+        # (вид объекта, хэш содержимого, шаблон, ofo) -> части сообщения
+        self.cache = LRUCache(cache_size)
         self._read()
 
     def _read(self):
-        if not self.templates_path.exists():
-            print("ERR: Файл с шаблонами не найден. Восстановите его и перезапустите.")
-            sys.exit(1)
         try:
-            self.__templates_raw.update(json.loads(self.templates_path.read_text("utf-8")))
-            self.__templates = {k: Template(**v) for k, v in self.__templates_raw.items()}
-            print("Файл с шаблонами загружен.")
-        except json.JSONDecodeError:
-            print("ERR: Файл с шаблонами поврежден. Восстановите его и перезапустите.")
+            self.__templates_raw.update(self.storage.load_templates())
+            self.__templates = self._compile(self.__templates_raw)
+            print("Шаблоны загружены.")
+        except StorageError as e:
+            print(f"ERR: {e}. Восстановите его и перезапустите.")
+            sys.exit(1)
+        except TemplateError as e:
+            print(f"ERR: {e}. Исправьте шаблон и перезапустите.")
             sys.exit(1)
 
+    @staticmethod
+    def _compile(raw: dict) -> dict[str, Template]:
+        templates = {}
+        for name, v in raw.items():
+            try:
+                templates[name] = Template(**v)
+            except TypeError as e:
+                raise TemplateError(f"Шаблон {name!r}: {e}") from None
+            except TemplateError as e:
+                raise TemplateError(f"Шаблон {name!r}, {e}") from None
+        return templates
+
     def reload(self):
-        if not self.templates_path.exists():
-            self.templates_path.write_text(json.dumps(self.__templates_raw), "utf-8")
-            return "ERR: Файл с шаблонами не найден. Файл восстановлен."
-        old = self.__templates_raw.copy()
-        self.__templates_raw.clear()
         try:
-            j = json.loads(self.templates_path.read_text("utf-8"))
-            if len(j) == 0:
-                return "ERR: Файл с шаблонами пуст. Изменения не применены."
-            self.__templates_raw.update()
-            self.__templates = {k: Template(**v) for k, v in self.__templates_raw.items()}
-            return "Файл с шаблонами загружен."
-        except json.JSONDecodeError:
-            self.__templates_raw = old
-            return "ERR: Файл с шаблонами поврежден. Изменения не применены."
+            raw = self.storage.load_templates()
+            if len(raw) == 0:
+                return "ERR: Шаблонов нет. Изменения не применены."
+            templates = self._compile(raw)
+        except StorageError as e:
+            return f"ERR: {e}. Изменения не применены."
+        except TemplateError as e:
+            return f"ERR: {e}. Изменения не применены."
+        self.__templates_raw, self.__templates = raw, templates
+        self.cache.clear()
+        return "Шаблоны загружены."
+
+    def apply_templates(self, raw: dict[str, dict]) -> tuple[set, set, set] | None:
+        """Компилирует только изменённые шаблоны; при ошибке остаются старые."""
+        if not raw:
+            print("WARN: Шаблонов нет, изменения не применены.")
+            return None
+        added, removed, changed = diff_keys(self.__templates_raw, raw)
+        try:
+            compiled = self._compile({name: raw[name] for name in added | changed})
+        except TemplateError as e:
+            print(f"ERR: {e}. Изменения не применены.")
+            return None
+        templates = {name: t for name, t in self.__templates.items() if name not in removed}
+        templates.update(compiled)
+        self.__templates_raw, self.__templates = raw, templates
+        stale = removed | changed
+        if stale:
+            self.cache.remove_where(lambda key: key[2] in stale)
+        return added, removed, changed
 
     @property
     def list(self) -> list[str]:
@@ -129,3 +283,27 @@ class Templator:
         if name not in self.list:
             return None
         return self.__templates.get(name)
+
+    def render_chunks(self, name_or_chat: str | ChatConfig, obj: Week | Day | Lesson, ofo: bool) -> tuple[Iterable[str], str] | None:
+        """
+        Template.render_chunks с кэшем: одинаковое расписание для многих чатов рендерится один раз.
+        При промахе части отдаются по мере рендера и попадают в кэш, когда прочитаны все.
+        """
+        name = name_or_chat.template if isinstance(name_or_chat, ChatConfig) else name_or_chat
+        key = (type(obj).__name__, obj.digest, name, ofo)
+        chunks = self.cache.get(key)
+        if chunks is not None:
+            return chunks, self.get(name).type
+        template = self.get(name)
+        if template is None:
+            return None
+
+        def stream():
+            done = []
+            for chunk in template.render_chunks(obj, ofo):
+                if chunk.strip():  # Пустое сообщение Telegram не примет
+                    done.append(chunk)
+                    yield chunk
+            self.cache.put(key, tuple(done))
+
+        return stream(), template.type
@@ -0,0 +1,74 @@
+import bisect
+import datetime
+from dataclasses import dataclass, field
+from zoneinfo import ZoneInfo
+
+from .parser import Week, Day, Lesson
+
+
+@dataclass
+class Timetable:
+    """Неделя чата, разложенная по датам и началу пар."""
+    digest: str  # Week.digest, из которой построено
+    days: dict[datetime.date, Day] = field(default_factory=dict)
+    starts: list[datetime.datetime] = field(default_factory=list)  # Отсортировано
+    lessons: list[tuple[Day, Lesson]] = field(default_factory=list)  # Параллельно starts
+
+    @classmethod
+    def build(cls, week: Week, date_pattern: str, timezone: ZoneInfo) -> "Timetable":
+        table = cls(week.digest)
+        starts = []
+        for day in week.days:
+            if isinstance(day, str) or not day.date:
+                continue
+            try:
+                date = datetime.datetime.strptime(day.date, date_pattern).date()
+            except ValueError:
+                continue
+            table.days[date] = day
+            for lesson in day.lessons:
+                if lesson.empty or not lesson.time:
+                    continue
+                try:
+                    h, m = lesson.start
+                except ValueError:
+                    continue
+                starts.append((datetime.datetime.combine(date, datetime.time(h, m), timezone), day, lesson))
+        starts.sort(key=lambda item: item[0])
+        table.starts = [start for start, _, _ in starts]
+        table.lessons = [(day, lesson) for _, day, lesson in starts]
+        return table
+
+    def day(self, date: datetime.date) -> Day | None:
+        return self.days.get(date)
+
+    def next_lesson(self, now: datetime.datetime) -> tuple[Day, Lesson] | None:
+        i = bisect.bisect_right(self.starts, now)
+        if i == len(self.starts):
+            return None
+        return self.lessons[i]
+
+
+class TimetableIndex:
+    """Расписания чатов в памяти для /today, /tomorrow и /next: без pandas и сети."""
+
+    def __init__(self, date_pattern: str, timezone: ZoneInfo):
+        self.date_pattern = date_pattern
+        self.timezone = timezone
+        self._tables: dict[int, Timetable] = {}
+
+    def put(self, chat_id: int, week: Week) -> Timetable:
+        # Новый файл у чата заменяет старую запись; та же неделя не перестраивается
+        table = self._tables.get(chat_id)
+        if table is None or table.digest != week.digest:
+            table = self._tables[chat_id] = Timetable.build(week, self.date_pattern, self.timezone)
+        return table
+
+    def get(self, chat_id: int) -> Timetable | None:
+        return self._tables.get(chat_id)
+
+    def now(self) -> datetime.datetime:
+        return datetime.datetime.now(self.timezone)
+
+    def __len__(self):
+        return len(self._tables)
@@ -0,0 +1,62 @@
+import asyncio
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Hashable
+
+
+def diff_keys(old: dict, new: dict) -> tuple[set, set, set]:
+    """(добавленные, удалённые, изменённые) ключи."""
+    added = new.keys() - old.keys()
+    removed = old.keys() - new.keys()
+    changed = {k for k in old.keys() & new.keys() if old[k] != new[k]}
+    return added, removed, changed
+
+
+@dataclass
+class Watched:
+    name: str
+    version: Callable[[], Hashable]  # Дешёвая проверка: mtime файла или data_version базы
+    load: Callable[[], Any]  # Чтение целиком, выполняется в потоке
+    apply: Callable[[Any], tuple[set, set, set] | None]  # Применение в event loop; None - данные отклонены
+    last: Hashable = None
+
+
+class StoreWatcher:
+    """Периодически проверяет хранилища и применяет изменения без /reload."""
+
+    def __init__(self, interval: float = 5):
+        self.interval = interval
+        self.watched: list[Watched] = []
+        self.reloads = 0
+        self.t: asyncio.Task | None = None
+
+    def watch(self, name: str, version: Callable[[], Hashable], load: Callable[[], Any],
+              apply: Callable[[Any], tuple[set, set, set] | None]):
+        self.watched.append(Watched(name, version, load, apply, version()))
+
+    async def check(self):
+        for w in self.watched:
+            version = await asyncio.to_thread(w.version)
+            if version == w.last:
+                continue
+            w.last = version
+            start = time.perf_counter()
+            try:
+                data = await asyncio.to_thread(w.load)
+                # Применение синхронное: обработчики видят либо старые данные, либо новые целиком
+                diff = w.apply(data)
+            except Exception as e:
+                print(f"WARN: Не удалось перечитать {w.name}: {e!r}")
+                continue
+            if diff is None:
+                continue
+            added, removed, changed = diff
+            if added or removed or changed:
+                self.reloads += 1
+                print(f"Перезагрузка {w.name}: +{len(added)} -{len(removed)} ~{len(changed)} "
+                      f"за {(time.perf_counter() - start) * 1000:.0f}мс")
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.check()
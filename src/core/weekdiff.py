@@ -0,0 +1,121 @@
+from dataclasses import dataclass, field
+
+from .parser import Week, Day, Lesson
+
+
+@dataclass
+class Change:
+    kind: str  # added, cancelled, moved, changed
+    day: Day  # День, в котором пара теперь (для cancelled - в котором была)
+    new: Lesson | None = None
+    old: Lesson | None = None
+    old_day: Day | None = None  # Для moved: откуда перенесли
+    fields: list[str] = field(default_factory=list)  # Для changed: что поменялось
+
+    def __str__(self):
+        match self.kind:
+            case "added":
+                return f" + {lesson_line(self.new)}"
+            case "cancelled":
+                return f" - {lesson_line(self.old)} - отменена"
+            case "moved":
+                where = f"{self.old_day.date} {self.old.time}" if self.old_day.date != self.day.date else self.old.time
+                return f" → {self.new.name}: {where} → {self.day.date} {self.new.time}"
+            case _:
+                changes = ", ".join(f"{getattr(self.old, f) or '—'} → {getattr(self.new, f) or '—'}" for f in self.fields)
+                return f" ~ {self.new.num + 1}. {self.new.name}: {changes}"
+
+
+def lesson_line(lesson: Lesson) -> str:
+    return f"{lesson.num + 1}. {lesson.time} {lesson.name} ({lesson.teacher or '—'}, {lesson.place or '—'})"
+
+
+def _key(lesson: Lesson) -> tuple:
+    # Одна и та же пара: предмет и преподаватель
+    return lesson.name, lesson.teacher
+
+
+def _match(old: list[Lesson], new: list[Lesson]) -> tuple[list[tuple[Lesson, Lesson]], list[Lesson], list[Lesson]]:
+    """Пары (старая, новая) с одинаковым предметом и преподавателем; оставшиеся старые и новые."""
+    pairs = []
+    new = list(new)
+    rest = []
+    for lesson in old:
+        candidates = [n for n in new if _key(n) == _key(lesson)]
+        if not candidates:
+            rest.append(lesson)
+            continue
+        # Если таких пар несколько, берём ближайшую по номеру
+        best = min(candidates, key=lambda n: abs(n.num - lesson.num))
+        new.remove(best)
+        pairs.append((lesson, best))
+    return pairs, rest, new
+
+
+def week_dates(week: Week) -> set[str]:
+    return {day.date for day in week.days if not isinstance(day, str) and day.date}
+
+
+def same_week(old: Week, new: Week) -> bool:
+    """Файлы описывают одну неделю. Иначе сравнение по парам превратит всю неделю в переносы."""
+    return str(old.date) == str(new.date) and bool(week_dates(old) & week_dates(new))
+
+
+def diff_weeks(old: Week, new: Week) -> list[Change]:
+    """Что поменялось в расписании: пары сопоставляются по дате, предмету и преподавателю."""
+    def lessons(week: Week) -> dict[str, tuple[Day, list[Lesson]]]:
+        return {day.date: (day, [lesson for lesson in day.lessons if not lesson.empty])
+                for day in week.days if not isinstance(day, str)}
+
+    old_days, new_days = lessons(old), lessons(new)
+    changes = []
+    cancelled: list[tuple[Day, Lesson]] = []
+    added: list[tuple[Day, Lesson]] = []
+    for date in old_days.keys() | new_days.keys():
+        old_day, old_lessons = old_days.get(date, (None, []))
+        new_day, new_lessons = new_days.get(date, (None, []))
+        if old_lessons == new_lessons:
+            continue
+        pairs, rest_old, rest_new = _match(old_lessons, new_lessons)
+        for o, n in pairs:
+            if o == n:
+                continue
+            if (o.num, o.time) != (n.num, n.time):
+                changes.append(Change("moved", new_day, n, o, old_day))
+            else:
+                fields = [f for f in ("place", "link") if getattr(o, f) != getattr(n, f)]
+                changes.append(Change("changed", new_day, n, o, fields=fields))
+        cancelled.extend((old_day, lesson) for lesson in rest_old)
+        added.extend((new_day, lesson) for lesson in rest_new)
+
+    # Пара могла переехать на другой день
+    for old_day, o in list(cancelled):
+        n = next(((d, n) for d, n in added if _key(n) == _key(o)), None)
+        if n is None:
+            continue
+        cancelled.remove((old_day, o))
+        added.remove(n)
+        changes.append(Change("moved", n[0], n[1], o, old_day))
+    changes.extend(Change("cancelled", day, old=lesson) for day, lesson in cancelled)
+    changes.extend(Change("added", day, lesson) for day, lesson in added)
+    return changes
+
+
+def changed_dates(changes: list[Change]) -> set[str]:
+    dates = set()
+    for change in changes:
+        dates.add(change.day.date)
+        if change.old_day is not None:
+            dates.add(change.old_day.date)
+    return dates
+
+
+def diff_blocks(changes: list[Change]) -> list[list[str]]:
+    """Текст изменений по дням: блоки для templator.pack_chunks."""
+    by_day: dict[str, list[Change]] = {}
+    days: dict[str, Day] = {}
+    for change in changes:
+        by_day.setdefault(change.day.date, []).append(change)
+        days[change.day.date] = change.day
+    return [[f"{date or '—'} {days[date].day_name}:\n"] + [f"{change}\n" for change in by_day[date]] + ["\n"]
+            for date in sorted(by_day, key=lambda d: tuple(reversed((d or "").split("."))))]
@@ -0,0 +1,83 @@
+import asyncio
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+
+def _init_worker():
+    # Тяжёлые импорты делаем один раз при старте процесса, а не в первой задаче
+    import pandas  # noqa: F401
+    import xlrd  # noqa: F401
+
+
+def _ping():
+    return True
+
+
+class ParsePool:
+    """Ограниченный пул процессов для разбора .xls вне event loop."""
+
+    def __init__(self, workers: int = 2, queue_size: int = 32):
+        self.workers = workers
+        # Сверх этого задачи ждут в asyncio и не копятся в очереди пула
+        self._slots = asyncio.Semaphore(queue_size)
+        self.executor = self._new_executor()
+        self.restarts = 0
+        self.pending = 0  # Задачи в очереди и в работе
+        self.jobs = 0
+        self.failed = 0
+        self.total_time = 0.0
+        self.last_time = 0.0
+        self.max_time = 0.0
+
+    def _new_executor(self) -> ProcessPoolExecutor:
+        # fork: main.py выполняет код при импорте, поэтому spawn/forkserver запустили бы бота в каждом процессе
+        return ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("fork"), initializer=_init_worker)
+
+    async def _restart(self, broken: ProcessPoolExecutor):
+        # Процесс упал (нехватка памяти, сбой в xlrd): такой пул больше не принимает задачи.
+        # Несколько задач могли упасть одновременно - пересоздаём только один раз
+        if self.executor is not broken:
+            return
+        self.restarts += 1
+        print("WARN: Процесс пула разбора завершился аварийно, пул перезапускается.")
+        broken.shutdown(wait=False, cancel_futures=True)
+        self.executor = self._new_executor()
+        await asyncio.to_thread(self.warm_up)
+
+    def warm_up(self):
+        # Каждая отправка без свободного процесса поднимает новый, так что все процессы стартуют сразу
+        for future in [self.executor.submit(_ping) for _ in range(self.workers)]:
+            future.result()
+        print(f"Пул разбора запущен: {self.workers} процессов.")
+
+    async def run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        self.pending += 1
+        start = time.perf_counter()
+        try:
+            async with self._slots:
+                executor = self.executor
+                return await loop.run_in_executor(executor, func, *args)
+        except BrokenProcessPool:
+            self.failed += 1
+            await self._restart(executor)
+            raise
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self.pending -= 1
+            self.jobs += 1
+            self.last_time = time.perf_counter() - start
+            self.total_time += self.last_time
+            self.max_time = max(self.max_time, self.last_time)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def __str__(self):
+        avg = self.total_time / self.jobs if self.jobs else 0
+        return (f"ParsePool(процессов: {self.workers}; в очереди: {self.pending}; задач: {self.jobs}; ошибок: {self.failed}; перезапусков: {self.restarts}; "
+                f"время: посл. {self.last_time * 1000:.0f}мс, сред. {avg * 1000:.0f}мс, макс. {self.max_time * 1000:.0f}мс)")
@@ -9,6 +9,15 @@ from telegram.ext import Application, MessageHandler, filters, ContextTypes
 
 from core import Templator, Config, Parser
 from core.scheduler import Scheduler, SchedulerSettings
+from core.sender import Sender, INTERACTIVE, BULK
+from core.parser import Day
+from core.storage import SqliteStorage, StorageError
+from core.store import StoredFile
+from core.timetable import Timetable, TimetableIndex
+from core.templator import pack_chunks, max_message_len
+from core.watcher import StoreWatcher
+from core.weekdiff import diff_weeks, changed_dates, diff_blocks, same_week, week_dates
+from core.workers import ParsePool
 
 # /set find 1 курс ОЗФО
 # /set sheet 1к Прикладная математика
@@ -17,6 +26,8 @@ help_msg = """\
 Доступные команды:
   /auto - автоматический поиск и обработка файла
   /file - обработка файла из ответа на сообщение
+  /today, /tomorrow - расписание на сегодня и завтра
+  /next - следующая пара
   /settings - Настройки чата
 Команды для настройки:
   (Для каждого чата настраивается отдельно)
@@ -31,6 +42,10 @@ help_msg_admin = r"""
 Админские команды:
   /set\_save\_path - установить путь для сохранения файлов
   /reload - перезагрузить данные (chats, links, templates)
+  /storage import|export - перенести данные между JSON файлами и базой SQLite
+  /scheduler [[chat_id]] - задачи планировщика
+  /compact - забыть чаты с настройками по умолчанию
+  /stats - состояние кэшей, пула разбора и очереди отправки
 """
 
 allow_set_cmds = ("help", "find", "sheet", "url")
@@ -65,47 +80,244 @@ loop = asyncio.new_event_loop()
 asyncio.set_event_loop(loop)
 
 config = Config("config.json")
-templator = Templator(config.templates)
-parser = Parser(config.links, config.save_path)
+templator = Templator(config.storage, config.cache['renders_size'])
+parse_pool = ParsePool(config.parse['workers'], config.parse['queue_size']) if config.parse['workers'] > 0 else None
+parser = Parser(config.storage, config.save_path, config.download, config.cache, parse_pool)
 
 scheduler = Scheduler(SchedulerSettings(**config.scheduler), loop)
-application = Application.builder().token(config.token).build()
+timetables = TimetableIndex(scheduler.settings.date_pattern, scheduler.settings.timezone)
+
+watcher = StoreWatcher(config.watch_interval)
+watcher.watch("chats", lambda: config.storage.version("chats"), config.storage.load_chats, config.apply_chats)
+watcher.watch("links", lambda: config.storage.version("links"), config.storage.load_links, parser.apply_links)
+watcher.watch("templates", lambda: config.storage.version("templates"), config.storage.load_templates, templator.apply_templates)
+
+
+async def on_startup(_application: Application):
+    sender.start()
+    if config.watch_interval > 0:
+        watcher.t = asyncio.create_task(watcher.run())
+    scheduler.t = asyncio.create_task(scheduler.start())
+
+
+async def on_shutdown(_application: Application):
+    await scheduler.stop()
+    if watcher.t:
+        watcher.t.cancel()
+    await sender.stop()
+    await config.close()
+    await parser.close()
+    parser.weeks.save()
+    if parse_pool:
+        parse_pool.shutdown()
+
+application = Application.builder().token(config.token).post_init(on_startup).post_shutdown(on_shutdown).build()
 bot = application.bot
+sender = Sender(bot, **config.send)
 username = loop.run_until_complete(bot.get_me()).username
 
 
-async def send_message(chat_id, text, parse_mode='Markdown'):
-    await bot.send_message(chat_id=chat_id, text=text, parse_mode=parse_mode, disable_web_page_preview=True)
+def scheduled_files() -> set[str]:
+    # Файлы, на которые ссылаются задачи планировщика, не удаляются при очистке
+    return {task.payload["sha256"] for task in scheduler.tasks if task.payload}
+
+parser.store.add_protector(scheduled_files)
+parser.store.add_protector(lambda: {sha256 for sha256, _sheet, _even_week in parser.weeks.keys()})
+
+
+async def evict_downloads(*_, **__):
+    settings = config.download
+    removed = await asyncio.to_thread(
+        parser.store.evict,
+        settings["max_size_mb"] * 1024 * 1024,
+        settings["max_age_days"] * 24 * 60 * 60,
+        parser.store.protected()
+    )
+    if removed:
+        print(f"Очистка загрузок: удалено файлов: {len(removed)}.")
+
+
+async def send_chunks(chat_id, chunks, parse_mode, priority=BULK):
+    # Каждую часть ждём: иначе разные обработчики очереди могут переставить части местами
+    for chunk in chunks:
+        await sender.send(chat_id, chunk, parse_mode, priority, wait=True, link_preview_options=LinkPreviewOptions(is_disabled=True))
+
 
+async def reply(update: Update, text, parse_mode=None, **kwargs):
+    # Ответ на команду через общую очередь, впереди уведомлений
+    message = update.message
+    if message.chat.type != 'private':
+        kwargs.setdefault("reply_to_message_id", message.message_id)
+    return await sender.send(message.chat_id, text, parse_mode, INTERACTIVE, wait=True, **kwargs)
 
-def send_ld(day_or_lesson, chat_id):
+
+async def send_ld(chat_id, payload):
+    # payload - ссылка на день или пару (см. Week.tasks); неделя берётся из кэша или разбирается заново
+    stored = parser.store.by_hash(payload["sha256"])
+    if stored is None:
+        print(f"WARN: Файл расписания {payload['sha256'][:12]} для {chat_id} удалён, уведомление пропущено.")
+        return
+    week = await parser.get_week(stored, payload["sheet"], payload["even_week"])
+    if isinstance(week, str):
+        print(f"ERR: {week}")
+        return
     c = config.get_chat(chat_id)
-    s = templator.get(c).render(day_or_lesson, c.ofo)
-    loop.create_task(send_message(chat_id, *s))
+    await send_chunks(chat_id, *templator.render_chunks(c, week.resolve(payload), c.ofo))
 
-async def render_and_send(update, context, file, even_week):
+scheduler.register("day", send_ld)
+scheduler.register("lesson", send_ld)
+
+async def render_and_send(update, context, stored: StoredFile, even_week, auto=False):
+    week_data = None
     try:
         chat_id = update.effective_chat.id
         chat = config.get_chat(chat_id)
-        week_data = parser.parse_xml(chat, file, even_week)
+        week_data = await parser.get_week(stored, chat.sheet_name, even_week)
         if isinstance(week_data, str):
             raise Exception(week_data)
 
-        async with scheduler.lock:
-            scheduler.tasks = [task for task in scheduler.tasks if not task.name.startswith(f"I:{chat_id}")]
-        scheduler.add_task(*week_data.tasks(send_ld, chat_id, config.scheduler['notify_day_at']))
+        timetables.put(chat_id, week_data)
+        # auto - файл с сайта (/auto): только такие расписания перепроверяет refresh_schedules
+        source = {"sha256": stored.sha256, "sheet": chat.sheet_name, "even_week": even_week, "auto": auto}
+        scheduler.replace_owner(chat_id, week_data.tasks(send_ld, chat_id, config.scheduler['notify_day_at'], source))
 
-        template = templator.get(chat)
-        text, parse_mode = template.render(week_data, chat.ofo)
-        await context.bot.send_message(chat_id=chat_id, text=text, parse_mode=parse_mode)
+        chunks, parse_mode = templator.render_chunks(chat, week_data, chat.ofo)
+        # Части рендерятся по одной: первая уходит, не дожидаясь остальных
+        await send_chunks(chat_id, chunks, parse_mode, INTERACTIVE)
     except Exception as e:
         traceback.print_exc()
-        await update.message.reply_text(f'Ошибка при обработке файла: {e}', parse_mode='Markdown')
-        os.remove(file)
+        await reply(update, f'Ошибка при обработке файла: {e}', parse_mode='Markdown')
+        if week_data is None and stored.sha256 not in parser.store.protected():
+            # Файл не читается: удаляем, чтобы в следующий раз скачать заново.
+            # Файлы, на которые ссылаются задачи других чатов или кэш недель, не трогаем: ошибка могла быть временной
+            parser.store.discard(stored.sha256)
+
+async def refresh_schedules(*_, **__):
+    """
+    Перепроверяет файлы, по которым у чатов есть задачи. Разбирает только изменившиеся,
+    присылает чатам список изменений и переставляет задачи только изменённых дней.
+    """
+    groups: dict[tuple, list[tuple[int, dict]]] = {}
+    for chat_id in scheduler.count_by_owner():
+        if chat_id is None:
+            continue
+        chat = config.get_chat(chat_id)
+        payloads = [task.payload for task in scheduler.tasks_for(chat_id) if task.payload]
+        if not payloads or not chat.ready() or not chat.use_scheduler:
+            continue
+        source = payloads[-1]  # Задачи добавляются по порядку, последняя - от самого свежего файла
+        if not source.get("auto"):
+            # Файл загружен через /file: сайт к нему отношения не имеет
+            continue
+        groups.setdefault((chat.url, chat.find, source["sheet"], source["even_week"]), []).append((chat_id, source))
+
+    for (url, find, sheet, even_week), chats in groups.items():
+        try:
+            stored = await parser.download(config.get_chat(chats[0][0]), even_week)
+            if stored is None or all(source["sha256"] == stored.sha256 for _, source in chats):
+                continue
+            new_week = await parser.get_week(stored, sheet, even_week)
+            if isinstance(new_week, str):
+                print(f"ERR: {new_week}")
+                continue
+            new_source = {"sha256": stored.sha256, "sheet": sheet, "even_week": even_week, "auto": True}
+            for chat_id, source in chats:
+                if source["sha256"] != stored.sha256:
+                    await apply_refresh(chat_id, source, new_week, new_source)
+        except Exception:
+            traceback.print_exc()
+
+def put_timetable(chat_id, week):
+    # /today и /next показывают текущую неделю, пока в ней остались дни; следующая неделя её не вытесняет
+    table = timetables.get(chat_id)
+    if table is not None and any(date >= timetables.now().date() for date in table.days):
+        new_table = Timetable.build(week, timetables.date_pattern, timetables.timezone)
+        if not table.days.keys() & new_table.days.keys():
+            return
+    timetables.put(chat_id, week)
+
+async def apply_refresh(chat_id, source: dict, new_week, new_source: dict):
+    old_stored = parser.store.by_hash(source["sha256"])
+    old_week = await parser.get_week(old_stored, source["sheet"], source["even_week"]) if old_stored else None
+    if old_week is None or isinstance(old_week, str):
+        # Старый файл удалён: сравнить не с чем, перепланируем всё
+        scheduler.replace_owner(chat_id, new_week.tasks(send_ld, chat_id, config.scheduler['notify_day_at'], new_source))
+        timetables.put(chat_id, new_week)
+        return
+    if not same_week(old_week, new_week):
+        # По ссылке уже другая неделя: напоминания оставшихся дней текущей недели не трогаем,
+        # снимаем только задачи на даты, которые есть в новом файле
+        dates = week_dates(new_week)
+        stale = [task for task in scheduler.tasks_for(chat_id)
+                 if task.payload and task.compiled.date is not None and task.compiled.date.strftime(task.date_pattern) in dates]
+        scheduler.cancel(*stale)
+        scheduler.add_task(*new_week.tasks(send_ld, chat_id, config.scheduler['notify_day_at'], new_source))
+        put_timetable(chat_id, new_week)
+        print(f"Чат {chat_id}: опубликована новая неделя {new_week.date}, задач снято {len(stale)}.")
+        return
+    changes = diff_weeks(old_week, new_week)
+    stale = []
+    if changes:
+        dates = changed_dates(changes)
+        stale = [task for task in scheduler.tasks_for(chat_id)
+                 if task.payload and task.payload["sha256"] == source["sha256"]
+                 and getattr(old_week.days[task.payload["day"]], "date", None) in dates]
+        scheduler.cancel(*stale)
+        tasks = new_week.tasks(send_ld, chat_id, config.scheduler['notify_day_at'], new_source)
+        scheduler.add_task(*(task for task in tasks if getattr(new_week.days[task.payload["day"]], "date", None) in dates))
+    # Оставшиеся задачи этой недели смотрят в новый файл: дни у версий одной недели на тех же местах.
+    # Иначе, если новых задач не добавилось (дни уже прошли), файл считался бы изменённым при каждой проверке.
+    # Задачи прошлой недели (после публикации новой) остаются со своим файлом
+    scheduler.update_payloads(chat_id, {"sha256": source["sha256"]}, sha256=new_source["sha256"])
+    put_timetable(chat_id, new_week)
+    if not changes:
+        return
+    print(f"Расписание чата {chat_id} обновлено: изменений {len(changes)}, задач снято {len(stale)}.")
+    blocks = [[f"Расписание изменилось ({new_source['sheet']}):\n\n"]] + diff_blocks(changes)
+    await send_chunks(chat_id, pack_chunks(blocks, max_message_len), None)
+
+async def chat_timetable(chat_id) -> Timetable | None:
+    table = timetables.get(chat_id)
+    if table is not None:
+        return table
+    # После перезапуска неделю чата находим по его задачам в планировщике
+    payload = next((task.payload for task in scheduler.tasks_for(chat_id) if task.payload), None)
+    if payload is None:
+        return None
+    stored = parser.store.by_hash(payload["sha256"])
+    if stored is None:
+        return None
+    week = await parser.get_week(stored, payload["sheet"], payload["even_week"])
+    if isinstance(week, str):
+        return None
+    return timetables.put(chat_id, week)
+
+async def handle_lookup(update: Update, cmd: str):
+    chat_id = update.effective_chat.id
+    table = await chat_timetable(chat_id)
+    if table is None:
+        await reply(update, "Расписание не загружено. Используйте /auto или /file.")
+        return
+    now = timetables.now()
+    match cmd:
+        case "/today":
+            obj = table.day(now.date())
+        case "/tomorrow":
+            obj = table.day(now.date() + timedelta(days=1))
+        case _:
+            found = table.next_lesson(now)
+            # Пара выводится вместе с заголовком своего дня
+            obj = Day(found[0].day_name, found[0].date, [found[1]]) if found else None
+    if obj is None:
+        await reply(update, "Пар нет." if cmd == "/next" else "На этот день расписания нет.")
+        return
+    chat = config.get_chat(chat_id)
+    chunks, parse_mode = templator.render_chunks(chat, obj, chat.ofo)
+    await send_chunks(chat_id, chunks, parse_mode, INTERACTIVE)
 
 async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message.reply_to_message and update.message.reply_to_message.document:
-        mid = await update.message.reply_text("Загрузка и анализ файла..", parse_mode='Markdown')
+        mid = await reply(update, "Загрузка и анализ файла..", parse_mode='Markdown')
         document = update.message.reply_to_message.document
         file_id = document.file_id
         new_file = await context.bot.get_file(file_id)
@@ -116,137 +328,146 @@ async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not filename.endswith('.xls'):
             await context.bot.editMessageText("Файл должен быть в формате `.xls`", mid.chat_id, mid.message_id, parse_mode='Markdown')
             return
-        file_path = config.save_path / filename
-        if file_path.exists():
+        even_week = None
+        if config.get_chat(update.message.chat.id).ofo:
+            even_week = not "1" in update.message.text
+        # file_unique_id одинаков только у одинаковых файлов, поэтому по нему можно не скачивать повторно
+        key = parser.store.key(f"tg:{document.file_unique_id}", even_week)
+        stored = parser.store.get(key)
+        if stored is not None:
             print(f"Файл '{filename}' уже существует.")
         else:
-            await new_file.download_to_drive(file_path)
+            tmp_path = parser.store.temp_path()
+            try:
+                await new_file.download_to_drive(tmp_path)
+                stored = await asyncio.to_thread(parser.store.add_file, key, filename, tmp_path)
+            finally:
+                if tmp_path.exists():
+                    tmp_path.unlink()
             print(f"Файл '{filename}' успешно сохранен!")
 
-        s = f'Документ сохранен: `{file_path.name}`.\nОбработка файла...'
+        s = f'Документ сохранен: `{stored.name}`.\nОбработка файла...'
         await context.bot.editMessageText(s, mid.chat_id, mid.message_id, parse_mode='Markdown')
-        even_week = None
-        if config.get_chat(update.message.chat.id).ofo:
-            even_week = not "1" in update.message.text
-        await render_and_send(update, context, file_path, even_week)
+        await render_and_send(update, context, stored, even_week)
     else:
-        await update.message.reply_text('Пожалуйста, ответьте на сообщение с документом.')
+        await reply(update, 'Пожалуйста, ответьте на сообщение с документом.')
 
 async def handle_auto(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not config.get_chat(update.effective_chat.id).ready():
-        await update.message.reply_text("Настройки не установлены.")
+        await reply(update, "Настройки не установлены.")
         return
     if config.get_chat(update.effective_chat.id).ofo:
-        await update.message.reply_text("Для ОФО нет поддержки так как админу лень делать поддержку 2х групп.\n"
+        await reply(update, "Для ОФО нет поддержки так как админу лень делать поддержку 2х групп.\n"
                                         "Админ: @id0124\n"
                                         "Ссылка на проект для тех, кто хочет что-то изменить: [github](https://github.com/SantaSpeen/fa-bot)",
                                         parse_mode='Markdown', link_preview_options=LinkPreviewOptions(True))
         return
-    mid = await update.message.reply_text("Поиск файла на сайте универа..", parse_mode='Markdown')
+    mid = await reply(update, "Поиск файла на сайте универа..", parse_mode='Markdown')
     chat = config.get_chat(update.effective_chat.id)
     even_week = None
     if chat.ofo:
         even_week = not "1" in update.message.text
-    file_path = parser.download(chat, even_week)
-    if not file_path:
+    stored = await parser.download(chat, even_week)
+    if not stored:
         await context.bot.editMessageText('Ошибка при загрузке файла.', mid.chat_id, mid.message_id, parse_mode='Markdown')
         return
-    s = f'Документ сохранен: `{file_path.name}`.\nОбработка файла...'
+    s = f'Документ сохранен: `{stored.name}`.\nОбработка файла...'
     await context.bot.editMessageText(s, mid.chat_id, mid.message_id, parse_mode='Markdown')
-    await render_and_send(update, context, file_path, even_week)
+    await render_and_send(update, context, stored, even_week, auto=True)
 
 async def handle_settings(update: Update):
     cmd = update.message.text.split(" ")
     cmd, setts = cmd[0], " ".join(cmd[1:])
     if not setts:
-        await update.message.reply_text(
+        await reply(update, 
             "Ипользуйте команду в формате `/set <команда> <значение>`\n"
             f"Доступные команды: `{'`, `'.join(allow_set_cmds)}`", parse_mode='Markdown')
         return
     data = setts.split(" ", 1)
     subcmd = data[0]
     if subcmd not in allow_set_cmds:
-        await update.message.reply_text(f"Недопустимая команда: `{subcmd}`")
+        await reply(update, f"Недопустимая команда: `{subcmd}`")
         return
     if subcmd == "help":
-        return await update.message.reply_text(set_help, parse_mode='Markdown')
+        return await reply(update, set_help, parse_mode='Markdown')
     if len(data) == 1:
-        await update.message.reply_text(f"Укажите значение для установки: `/set {subcmd} <значение>`", "Markdown")
+        await reply(update, f"Укажите значение для установки: `/set {subcmd} <значение>`", "Markdown")
         return
     set_data = data[1]
     chat = config.get_chat(update.message.chat.id)
     match subcmd:
         case "url":
-            chat.url = set_data
-            await update.message.reply_text(f"URL страницы с расписанием изменен на `{set_data}`", parse_mode='Markdown')
+            config.edit_chat(update.message.chat.id).url = set_data
+            await reply(update, f"URL страницы с расписанием изменен на `{set_data}`", parse_mode='Markdown')
         case "find":
             if not chat.check_find(set_data):
-                await update.message.reply_text(f"Недопустимое значение: `{set_data}`", parse_mode='Markdown')
+                await reply(update, f"Недопустимое значение: `{set_data}`", parse_mode='Markdown')
                 return
-            chat.find = set_data
-            await update.message.reply_text(f"Строка для поиска файла изменена на `{set_data}`", parse_mode='Markdown')
+            config.edit_chat(update.message.chat.id).find = set_data
+            await reply(update, f"Строка для поиска файла изменена на `{set_data}`", parse_mode='Markdown')
         case "sheet":
             if not chat.check_sheet(set_data):
-                await update.message.reply_text(f"Недопустимое значение: `{set_data}`", parse_mode='Markdown')
+                await reply(update, f"Недопустимое значение: `{set_data}`", parse_mode='Markdown')
                 return
+            chat = config.edit_chat(update.message.chat.id)
             chat.sheet_name = chat.fix_sheet(set_data)
-            await update.message.reply_text(f"Название листа в файле с расписанием изменено на `{set_data}`. "
+            await reply(update, f"Название листа в файле с расписанием изменено на `{set_data}`. "
                                             f"{"Чётность недели убрана." if chat.sheet_name != set_data else ""}", parse_mode='Markdown')
 
 async def handle_template(update: Update):
     cmd = update.message.text.split(" ")
     cmd, setts = cmd[0], " ".join(cmd[1:])
     if not setts:
-        await update.message.reply_text(
+        await reply(update, 
             "Ипользуйте команду в формате `/template <команда> [значение]`\n"
             f"Доступные команды: `{'`, `'.join(allow_template_cmds)}`", parse_mode='Markdown')
         return
     data = setts.split(" ", 1)
     subcmd = data[0]
     if subcmd not in allow_template_cmds:
-        await update.message.reply_text(f"Недопустимая команда: `{subcmd}`")
+        await reply(update, f"Недопустимая команда: `{subcmd}`")
         return
     chat = config.get_chat(update.message.chat.id)
     match subcmd, len(data):
         case "help", _:
-            await update.message.reply_text(template_help, parse_mode='Markdown')
+            await reply(update, template_help, parse_mode='Markdown')
         case "list", 1:
             _s = ""
             for tem in templator.list:
                 _s += f"  - `{tem}`\n"
             s = f"Доступные шаблоны:\n{_s}"
-            await update.message.reply_text(s, "Markdown")
+            await reply(update, s, "Markdown")
         case "use", 2:
             set_data = data[1]
             if set_data in templator.list:
-                await update.message.reply_text(f"Установлено новое значение: `{chat.template}` > `{set_data}`", 'Markdown')
-                chat.template = set_data
+                await reply(update, f"Установлено новое значение: `{chat.template}` > `{set_data}`", 'Markdown')
+                config.edit_chat(update.message.chat.id).template = set_data
                 return
-            await update.message.reply_text(f"Шаблон '{set_data}' не найден.", 'Markdown')
+            await reply(update, f"Шаблон '{set_data}' не найден.", 'Markdown')
         case "custom", 2:
-            await update.message.reply_text("Загрузка кастомных шаблонов пока что не реализована.", 'Markdown')
+            await reply(update, "Загрузка кастомных шаблонов пока что не реализована.", 'Markdown')
             # chat.template = "custom"
             # chat.use_custom_template = True
         case _:
-            await update.message.reply_text("Недопустимая команда.", "Markdown")
+            await reply(update, "Недопустимая команда.", "Markdown")
 
 
 async def handle_private_messages(update, cmd, setts):
     match cmd:
         case "/start":
-            await update.message.reply_text("/help")
+            await reply(update, "/help")
         case "/help":
             uid = update.message.from_user.id
-            await update.message.reply_text(
+            await reply(update, 
                 help_msg.format("") if not uid in config.admins else help_msg.format(help_msg_admin),
                 parse_mode='Markdown', disable_web_page_preview=True
             )
         case "/set_save_path":
             if not update.message.from_user.id in config.admins:
-                await update.message.reply_text("Ты не админ")
+                await reply(update, "Ты не админ")
                 return
             if not setts:
-                await update.message.reply_text(
+                await reply(update, 
                     f"Укажите путь для сохранения файлов: `/set_save_path <path>`\nTекущий путь: `{config.save_path}`",
                     parse_mode='Markdown')
                 return
@@ -255,24 +476,80 @@ async def handle_private_messages(update, cmd, setts):
                 config.config_file['save_path'] = setts
                 if not os.path.exists(config.config_file['save_path']):
                     os.makedirs(config.config_file['save_path'])
-                await update.message.reply_text(f"Путь для сохранения файлов изменен с `{old_path}` на `{setts}`",
+                await reply(update, f"Путь для сохранения файлов изменен с `{old_path}` на `{setts}`",
                                                 parse_mode='Markdown')
             except Exception as e:
-                await update.message.reply_text(f"Ошибка при изменении пути: {e}")
+                await reply(update, f"Ошибка при изменении пути: {e}")
                 config.config_file['save_path'] = old_path
             config.save()
         case "/reload":
             if not update.message.from_user.id in config.admins:
-                await update.message.reply_text("Ты не админ")
+                await reply(update, "Ты не админ")
+                return
+            await reply(update, f"Chats Store:\n  {config.reload_chats()}")
+            await reply(update, f"Links:\n  {parser.reload()}")
+            await reply(update, f"Templates:\n  {templator.reload()}")
+        case "/compact":
+            if not update.message.from_user.id in config.admins:
+                await reply(update, "Ты не админ")
+                return
+            removed = config.compact_chats()
+            await reply(update, f"Удалено чатов с настройками по умолчанию: {removed}. Осталось: {config.chats_count}.")
+        case "/storage":
+            if not update.message.from_user.id in config.admins:
+                await reply(update, "Ты не админ")
                 return
-            await update.message.reply_text(f"Chats Store:\n  {config.reload_chats()}")
-            await update.message.reply_text(f"Links:\n  {parser.reload()}")
-            await update.message.reply_text(f"Templates:\n  {templator.reload()}")
+            if not isinstance(config.storage, SqliteStorage):
+                await reply(update, f"Данные и так хранятся в JSON: {config.storage}")
+                return
+            try:
+                match setts:
+                    case "import":
+                        # После импорта подхватываем новые данные
+                        await reply(update, await asyncio.to_thread(config.storage.import_from, config.json_storage))
+                        await reply(update, f"{config.reload_chats()}\n{parser.reload()}\n{templator.reload()}")
+                    case "export":
+                        config.flush_chats()
+                        await reply(update, await asyncio.to_thread(config.storage.export_to, config.json_storage))
+                    case _:
+                        await reply(update, "Использование: /storage import|export")
+            except StorageError as e:
+                await reply(update, f"ERR: {e}")
         case "/scheduler":
             if not update.message.from_user.id in config.admins:
-                await update.message.reply_text("Ты не админ")
+                await reply(update, "Ты не админ")
                 return
-            await update.message.reply_text(f"{len(scheduler.tasks)} tasks:\n" + "\n".join(str(task) for task in scheduler.tasks))
+            if setts:
+                # /scheduler <chat_id> - задачи одного чата
+                tasks = scheduler.tasks_for(int(setts)) if setts.lstrip("-").isdigit() else []
+                lines = [f"{len(tasks)} tasks:\n"]
+                for task in tasks:
+                    line = f"{task} +{task.jitter:.0f}с"
+                    if task.delay is not None:
+                        line += f"; задержка {task.delay:.1f}с"
+                    lines.append(line + "\n")
+            else:
+                by_kind = ", ".join(f"{kind}: {count}" for kind, count in scheduler.count_by_kind().items())
+                by_owner = sorted(((owner, count) for owner, count in scheduler.count_by_owner().items() if owner is not None),
+                                  key=lambda item: item[1], reverse=True)
+                lines = [f"{len(scheduler.tasks)} tasks ({by_kind})\n{scheduler}\nПо чатам:\n"]
+                lines += [f"  {owner}: {count}\n" for owner, count in by_owner] or ["  нет\n"]
+            # Чатов и задач может быть много: список делится на сообщения по границам строк
+            await send_chunks(update.message.chat_id, pack_chunks(([line] for line in lines), max_message_len), None, INTERACTIVE)
+        case "/stats":
+            if not update.message.from_user.id in config.admins:
+                await reply(update, "Ты не админ")
+                return
+            await reply(update, 
+                f"Загрузки: {parser.downloads}\n"
+                f"Разборы: {parser.parses}\n"
+                f"Страница расписания: {parser.index_cache}\n"
+                f"Недели: {parser.weeks}\n"
+                f"Рендер: {templator.cache}\n"
+                f"Разбор: {parse_pool or 'в основном процессе'}\n"
+                f"Планировщик: {scheduler}\n"
+                f"Отправка: {sender}"
+            )
 
 # Функция для обработки ответов на сообщения
 async def handle_messages(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -292,12 +569,12 @@ async def handle_messages(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             await handle_auto(update, context)
         case "/file":
             await handle_file(update, context)
+        case "/today" | "/tomorrow" | "/next":
+            await handle_lookup(update, cmd)
         case "/set":
             await handle_settings(update)
-            config.save_chats()
         case "/template":
             await handle_template(update)
-            config.save_chats()
         case "/settings":
             chat = config.get_chat(update.message.chat.id)
             s = (
@@ -314,15 +591,17 @@ async def handle_messages(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             if update.message.chat.type == 'private' and update.message.from_user.id in config.admins:
                 s += ("\n\n**Админские настройки**:\n"
                       f" Путь для сохранения файлов: `{config.save_path}`")
-            await update.message.reply_text(s, parse_mode='Markdown')
+            await reply(update, s, parse_mode='Markdown')
             if chat.use_custom_template:
                 document = InputFile(json.dumps(chat.custom_template), "custom_template.json")
                 await update.message.reply_document(document)
 
 def main():
-    # Регистрируем scheduler
-    scheduler.add_prune_task()
-    _scheduler_job = application.job_queue.run_repeating(scheduler.tick, timedelta(seconds=1))
+    if parse_pool:
+        parse_pool.warm_up()
+    _evict_job = application.job_queue.run_repeating(evict_downloads, timedelta(seconds=config.download['evict_interval']), first=10)
+    if config.refresh['interval'] > 0:
+        _refresh_job = application.job_queue.run_repeating(refresh_schedules, timedelta(seconds=config.refresh['interval']), first=60)
 
     # Регистрация обработчиков
     application.add_handler(MessageHandler(filters.TEXT & filters.REPLY, handle_messages))